@@ -0,0 +1 @@
+"""trapi-throttle benchmarks."""
@@ -0,0 +1,53 @@
+"""
+Benchmark decoding and validating a KP response.
+
+Compares the stdlib decoder followed by reasoner-pydantic parsing with
+the fast decoder (orjson, if installed) followed by each validation mode.
+
+Usage: python -m benchmarks.decode
+"""
+import json
+
+from reasoner_pydantic import Response as ReasonerResponse
+
+from trapi_throttle.serialization import loads, orjson
+from trapi_throttle.trapi import check_response
+
+from .split import timed
+from .synthetic import merged_message
+
+CASES = [
+    # (curies, results per curie)
+    (10, 100),
+    (100, 100),
+    (100, 300),
+]
+
+MODES = {
+    "full": lambda data: ReasonerResponse.parse_obj(loads(data)).dict(),
+    "structural": lambda data: check_response(loads(data)),
+    "none": loads,
+}
+
+
+def baseline(data: bytes) -> dict:
+    """Decode and validate the way responses used to be."""
+    return ReasonerResponse.parse_obj(json.loads(data)).dict()
+
+
+def main():
+    print(f"decoder: {'orjson' if orjson is not None else 'json'}")
+    print(f"{'results':>8} {'MB':>6} {'baseline (s)':>13}" + "".join(
+        f" {mode + ' (s)':>15}" for mode in MODES
+    ))
+    for n_curies, results_per_curie in CASES:
+        message, _ = merged_message(n_curies, results_per_curie)
+        data = json.dumps({"message": message}).encode()
+        line = f"{len(message['results']):>8} {len(data) / 1e6:>6.1f} {timed(baseline, data):>13.4f}"
+        for decode in MODES.values():
+            line += f" {timed(decode, data):>15.4f}"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,317 @@
+"""
+End-to-end throughput and latency benchmark.
+
+Drives the Throttle (or the FastAPI app) with a stream of queries
+against a local stand-in KP that is rate limited with the test suite's
+RateLimitMiddleware, and reports throughput, latency percentiles, batch
+fill and KP-call efficiency. Results are written as JSON so that runs
+of different versions can be compared.
+
+Usage: python -m benchmarks.e2e [--scenario NAME ...] [--driver library|app]
+                                [--output FILE] [--baseline FILE]
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import platform
+import random
+import statistics
+import time
+from typing import Any
+
+from asgiar import ASGIAR
+from fastapi import FastAPI, Request
+from starlette.responses import Response
+import httpx
+
+from tests.utils import RateLimitMiddleware, url_to_host
+from trapi_throttle.throttle import Throttle
+
+KP_URL = "http://kp-bench/query"
+
+DEFAULTS = {
+    # queries per second (Poisson arrivals) and how many to send
+    "arrival_rate": 200.0,
+    "n_queries": 1000,
+    # predicate -> weight; each predicate is a query graph shape
+    "shapes": {"biolink:treats": 1.0},
+    # curies per query, drawn from a pool of distinct curies
+    "curies_per_query": 1,
+    "curie_pool": 10000,
+    # stand-in KP
+    "kp_latency": 0.05,
+    "kp_request_qty": 10,
+    "kp_request_duration": 1.0,
+    "results_per_curie": 5,
+    "node_bytes": 100,
+    # throttle settings for the KP (request_qty/duration default to the KP's)
+    "throttle": {},
+    "seed": 0,
+}
+
+SCENARIOS = {
+    "steady": {},
+    "bursty": {"arrival_rate": 2000.0, "n_queries": 2000},
+    "mixed_shapes": {
+        "shapes": {
+            "biolink:treats": 4.0,
+            "biolink:affects": 2.0,
+            "biolink:related_to": 1.0,
+            "biolink:interacts_with": 1.0,
+        },
+    },
+    "slow_kp": {"kp_latency": 0.5, "throttle": {"max_in_flight": 4}},
+    "large_responses": {"results_per_curie": 50, "node_bytes": 1000, "n_queries": 500},
+    "multi_curie": {"curies_per_query": 5, "throttle": {"max_batch_size": 50}},
+}
+
+
+def stand_in_kp(config: dict) -> FastAPI:
+    """
+    Build a KP that answers after kp_latency seconds with results_per_curie
+    results for each curie of the first pinned qnode.
+    """
+    app = FastAPI()
+    padding = "x" * config["node_bytes"]
+    app.state.calls = 0
+
+    @app.post("/query")
+    async def query(request: Request):
+        app.state.calls += 1
+        body = json.loads(await request.body())
+        qgraph = body["message"]["query_graph"]
+        pinned = [
+            (node_id, node["ids"])
+            for node_id, node in qgraph["nodes"].items()
+            if node.get("ids")
+        ]
+        unpinned = [node_id for node_id in qgraph["nodes"] if node_id not in dict(pinned)]
+        edge_id, edge = next(iter(qgraph["edges"].items()), (None, None))
+        nodes, edges, results = dict(), dict(), []
+        if pinned and unpinned and edge is not None:
+            node_id, curies = pinned[0]
+            for curie in curies:
+                nodes[curie] = {"categories": ["biolink:ChemicalSubstance"]}
+                for index in range(config["results_per_curie"]):
+                    object_id = f"MONDO:{index}"
+                    nodes[object_id] = {
+                        "categories": ["biolink:Disease"],
+                        "attributes": [{"attribute_type_id": "biolink:description", "value": padding}],
+                    }
+                    kedge_id = f"{curie}-{index}"
+                    edges[kedge_id] = {
+                        "subject": curie,
+                        "object": object_id,
+                        "predicate": (edge.get("predicates") or ["biolink:related_to"])[0],
+                    }
+                    results.append({
+                        "node_bindings": {
+                            node_id: [{"id": curie}],
+                            unpinned[0]: [{"id": object_id}],
+                        },
+                        "edge_bindings": {edge_id: [{"id": kedge_id}]},
+                    })
+        await asyncio.sleep(config["kp_latency"])
+        return Response(json.dumps({"message": {
+            "query_graph": qgraph,
+            "knowledge_graph": {"nodes": nodes, "edges": edges},
+            "results": results,
+        }}), media_type="application/json")
+
+    app.add_middleware(
+        RateLimitMiddleware,
+        request_qty=config["kp_request_qty"],
+        request_duration=datetime.timedelta(seconds=config["kp_request_duration"]),
+    )
+    return app
+
+
+def workload(config: dict) -> list[tuple[float, dict]]:
+    """Queries and their arrival times (seconds from the start)."""
+    rng = random.Random(config["seed"])
+    predicates = list(config["shapes"])
+    weights = list(config["shapes"].values())
+    queries = []
+    arrival = 0.0
+    for _ in range(config["n_queries"]):
+        arrival += rng.expovariate(config["arrival_rate"])
+        curies = [
+            f"CHEBI:{rng.randrange(config['curie_pool'])}"
+            for _ in range(config["curies_per_query"])
+        ]
+        queries.append((arrival, {"message": {"query_graph": {
+            "nodes": {
+                "n0": {"ids": curies},
+                "n1": {"categories": ["biolink:Disease"]},
+            },
+            "edges": {
+                "e0": {
+                    "subject": "n0",
+                    "object": "n1",
+                    "predicates": rng.choices(predicates, weights)[:1],
+                },
+            },
+        }}}))
+    return queries
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    """Nearest-rank percentile."""
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+async def drive(send, queries: list[tuple[float, Any]]) -> tuple[list[float], int, float]:
+    """
+    Send queries at their arrival times (seconds from the start).
+
+    Returns the latencies of successful queries, the number of
+    failures and the wall time.
+    """
+    latencies = []
+    failures = 0
+
+    async def timed_send(arrival: float, query: Any):
+        nonlocal failures
+        await asyncio.sleep(max(0.0, start + arrival - time.monotonic()))
+        sent = time.monotonic()
+        try:
+            await send(query)
+        except Exception:
+            failures += 1
+        else:
+            latencies.append(time.monotonic() - sent)
+
+    start = time.monotonic()
+    await asyncio.gather(*(timed_send(arrival, query) for arrival, query in queries))
+    return latencies, failures, time.monotonic() - start
+
+
+async def run(config: dict, driver: str = "library") -> dict:
+    """Run a scenario and summarize it."""
+    kp = stand_in_kp(config)
+    kp_info = {
+        "url": KP_URL,
+        "request_qty": config["kp_request_qty"],
+        "request_duration": config["kp_request_duration"],
+        **config["throttle"],
+    }
+    queries = workload(config)
+
+    async with ASGIAR(kp, host=url_to_host(KP_URL)):
+        if driver == "library":
+            async with Throttle() as throttle:
+                await throttle.register_kp("kp", kp_info)
+                server = throttle.servers["kp"]
+                latencies, failures, wall = await drive(
+                    lambda query: throttle.query("kp", query),
+                    queries,
+                )
+                stats = server.batch_stats()
+                rate_limited = server.metrics.rate_limited.value
+        elif driver == "app":
+            from trapi_throttle.server import APP
+
+            await APP.router.startup()
+            try:
+                async with httpx.AsyncClient(app=APP, base_url="http://throttle", timeout=None) as client:
+                    response = await client.post("/register/kp", json=kp_info)
+                    response.raise_for_status()
+
+                    async def send(query: dict):
+                        response = await client.post("/kp/query", json=query)
+                        response.raise_for_status()
+
+                    latencies, failures, wall = await drive(send, queries)
+                    stats = (await client.get("/kp/batch_stats")).json()
+                    rate_limited = APP.throttle.servers["kp"].metrics.rate_limited.value
+            finally:
+                await APP.router.shutdown()
+        else:
+            raise ValueError(f"Unknown driver {driver}")
+
+    return {
+        "queries": len(queries),
+        "failures": failures,
+        "wall_seconds": wall,
+        "throughput": len(latencies) / wall,
+        "latency_p50": percentile(latencies, 0.5),
+        "latency_p99": percentile(latencies, 0.99),
+        "latency_mean": statistics.fmean(latencies) if latencies else float("nan"),
+        "kp_calls": kp.state.calls,
+        "kp_429s": rate_limited,
+        # sub-requests answered per KP call
+        "kp_call_efficiency": len(queries) / kp.state.calls if kp.state.calls else float("nan"),
+        "batch_stats": stats,
+    }
+
+
+COMPARED = ("throughput", "latency_p50", "latency_p99", "kp_call_efficiency")
+
+
+def relative_change(before: float, after: float) -> float:
+    """Change from before to after, as a fraction of before."""
+    return (after - before) / before if before else float("nan")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--scenario", action="append", choices=list(SCENARIOS))
+    parser.add_argument("--driver", choices=["library", "app"], default="library")
+    parser.add_argument("--output", help="JSON file to write results to")
+    parser.add_argument("--baseline", help="JSON file of an earlier run to compare against")
+    parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="KEY=JSON",
+        help='override a setting of every scenario, e.g. --set n_queries=200 --set throttle={"linger":0.05}',
+    )
+    args = parser.parse_args()
+
+    overrides = dict()
+    for setting in args.set:
+        key, _, value = setting.partition("=")
+        if key not in DEFAULTS:
+            parser.error(f"unknown setting {key}")
+        overrides[key] = json.loads(value)
+
+    report = {
+        "started": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "driver": args.driver,
+        "scenarios": dict(),
+    }
+    print(f"{'scenario':<16} {'q/s':>7} {'p50 (s)':>8} {'p99 (s)':>8} {'fill':>6} {'eff':>6} {'429s':>5} {'fail':>5}")
+    for name in args.scenario or SCENARIOS:
+        config = {**DEFAULTS, **SCENARIOS[name], **overrides}
+        results = asyncio.run(run(config, args.driver))
+        report["scenarios"][name] = {"config": config, "results": results}
+        print(
+            f"{name:<16} {results['throughput']:>7.1f} {results['latency_p50']:>8.3f} "
+            f"{results['latency_p99']:>8.3f} {results['batch_stats']['mean_subrequests']:>6.1f} "
+            f"{results['kp_call_efficiency']:>6.1f} {results['kp_429s']:>5} {results['failures']:>5}"
+        )
+
+    if args.baseline:
+        with open(args.baseline) as stream:
+            baseline = json.load(stream)["scenarios"]
+        print(f"\nchange from {args.baseline}")
+        for name, scenario in report["scenarios"].items():
+            if name not in baseline:
+                continue
+            print(f"{name:<16}", " ".join(
+                f"{key} {relative_change(baseline[name]['results'][key], scenario['results'][key]):+.1%}"
+                for key in COMPARED
+            ))
+
+    if args.output:
+        with open(args.output, "w") as stream:
+            json.dump(report, stream, indent=2)
+
+
+if __name__ == "__main__":
+    main()
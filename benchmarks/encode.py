@@ -0,0 +1,69 @@
+"""
+Benchmark encoding the responses split from a merged KP response.
+
+Compares encoding each response on its own with the stdlib encoder
+(as JSONResponse does), encoding them through a shared memo of
+knowledge graph node, edge and result encodings, and encoding each
+response on its own with orjson, if it is installed.
+
+Usage: python -m benchmarks.encode
+"""
+import json
+
+from trapi_throttle.serialization import FragmentMemo, TRAPIResponse, orjson
+from trapi_throttle.trapi import filter_by_curie_mapping, index_results
+
+from .split import timed
+from .synthetic import merged_message
+
+CASES = [
+    # (curies, results per curie)
+    (10, 100),
+    (100, 100),
+    (100, 300),
+]
+
+
+def split(message, curie_mappings) -> list[dict]:
+    """Split the message into a response per sub-request."""
+    index = index_results(message["results"])
+    responses = []
+    for curie_mapping in curie_mappings.values():
+        kgraph, results = filter_by_curie_mapping(message, curie_mapping, index=index)
+        responses.append({"message": {
+            "query_graph": message["query_graph"],
+            "knowledge_graph": kgraph,
+            "results": results,
+        }})
+    return responses
+
+
+def separately(responses: list[dict]) -> list[bytes]:
+    return [json.dumps(response).encode() for response in responses]
+
+
+def shared(responses: list[dict]) -> list[bytes]:
+    memo = FragmentMemo()
+    return [TRAPIResponse(response, memo).encode_fragments() for response in responses]
+
+
+def with_orjson(responses: list[dict]) -> list[bytes]:
+    return [orjson.dumps(response) for response in responses]
+
+
+def main():
+    print(f"{'curies':>7} {'results':>8} {'json (s)':>9} {'shared (s)':>11} {'orjson (s)':>11}")
+    for n_curies, results_per_curie in CASES:
+        message, curie_mappings = merged_message(n_curies, results_per_curie)
+        responses = split(message, curie_mappings)
+        assert [json.loads(data) for data in shared(responses)] == responses
+        orjson_time = timed(with_orjson, responses) if orjson is not None else float("nan")
+        print(
+            f"{n_curies:>7} {len(message['results']):>8} "
+            f"{timed(separately, responses):>9.4f} {timed(shared, responses):>11.4f} "
+            f"{orjson_time:>11.4f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
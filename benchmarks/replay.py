@@ -0,0 +1,176 @@
+"""
+Replay captured traffic against local stand-in KPs.
+
+Sends queries captured with CAPTURE_FILE through the Throttle at their
+original pace (or faster or slower), once for each variant of the KP
+settings, to show how batching and latency would change before a
+config change is rolled out. Every captured KP is replaced by a stand-in
+(see benchmarks.e2e) with the same rate limit.
+
+Usage: python -m benchmarks.replay CAPTURE [--speed X] [--limit N]
+                                   [--variant NAME=JSON ...] [--kp KEY=JSON ...]
+                                   [--output FILE]
+
+e.g. python -m benchmarks.replay capture.jsonl \\
+         --variant 'batch50={"max_batch_size": 50}' \\
+         --variant 'linger={"linger": 0.05}'
+"""
+import argparse
+import asyncio
+from contextlib import AsyncExitStack
+import copy
+import json
+import statistics
+
+from asgiar import ASGIAR
+
+from tests.utils import url_to_host
+from trapi_throttle.capture import read_capture
+from trapi_throttle.throttle import Throttle
+
+from .e2e import COMPARED, DEFAULTS, drive, percentile, relative_change, stand_in_kp
+
+# Settings of the stand-in KPs
+KP_DEFAULTS = {
+    key: DEFAULTS[key]
+    for key in ("kp_latency", "kp_request_qty", "kp_request_duration", "results_per_curie", "node_bytes")
+}
+
+
+async def replay(
+        records: list[tuple[float, str, dict]],
+        kp_config: dict,
+        kp_settings: dict,
+        speed: float = 1.0,
+) -> dict:
+    """
+    Replay captured records through a Throttle with the given
+    settings for every KP, and summarize the run.
+    """
+    kp_ids = sorted({kp_id for _, kp_id, _ in records})
+    urls = {kp_id: f"http://replay-kp{index}/query" for index, kp_id in enumerate(kp_ids)}
+    kps = {kp_id: stand_in_kp(kp_config) for kp_id in kp_ids}
+    start = records[0][0]
+    queries = [
+        ((timestamp - start) / speed, (kp_id, query))
+        for timestamp, kp_id, query in copy.deepcopy(records)
+    ]
+
+    async with AsyncExitStack() as stack:
+        for kp_id, kp in kps.items():
+            await stack.enter_async_context(ASGIAR(kp, host=url_to_host(urls[kp_id])))
+        throttle = await stack.enter_async_context(Throttle())
+        for kp_id in kp_ids:
+            await throttle.register_kp(kp_id, {
+                "url": urls[kp_id],
+                "request_qty": kp_config["kp_request_qty"],
+                "request_duration": kp_config["kp_request_duration"],
+                **kp_settings,
+            })
+        latencies, failures, wall = await drive(
+            lambda item: throttle.query(*item),
+            queries,
+        )
+        per_kp = {
+            kp_id: {
+                "queries": sum(1 for _, (query_kp_id, _) in queries if query_kp_id == kp_id),
+                "kp_calls": kps[kp_id].state.calls,
+                "kp_429s": server.metrics.rate_limited.value,
+                "batch_stats": server.batch_stats(),
+            }
+            for kp_id, server in throttle.servers.items()
+        }
+
+    kp_calls = sum(kp.state.calls for kp in kps.values())
+    return {
+        "queries": len(queries),
+        "failures": failures,
+        "wall_seconds": wall,
+        "throughput": len(latencies) / wall,
+        "latency_p50": percentile(latencies, 0.5),
+        "latency_p99": percentile(latencies, 0.99),
+        "latency_mean": statistics.fmean(latencies) if latencies else float("nan"),
+        "kp_calls": kp_calls,
+        "kp_429s": sum(kp["kp_429s"] for kp in per_kp.values()),
+        "kp_call_efficiency": len(queries) / kp_calls if kp_calls else float("nan"),
+        "kps": per_kp,
+    }
+
+
+def parse_settings(parser, settings: list[str]) -> dict:
+    """Parse KEY=JSON arguments."""
+    parsed = dict()
+    for setting in settings:
+        key, _, value = setting.partition("=")
+        try:
+            parsed[key] = json.loads(value)
+        except json.JSONDecodeError:
+            parser.error(f"{key}: {value} is not valid JSON")
+    return parsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("capture", help="JSON lines file written with CAPTURE_FILE")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay this many times faster than captured")
+    parser.add_argument("--limit", type=int, help="only replay the first LIMIT queries")
+    parser.add_argument(
+        "--variant",
+        action="append",
+        default=[],
+        metavar="NAME=JSON",
+        help="KP settings to compare against the defaults, e.g. 'linger={\"linger\": 0.05}'",
+    )
+    parser.add_argument(
+        "--kp",
+        action="append",
+        default=[],
+        metavar="KEY=JSON",
+        help=f"stand-in KP setting, one of {', '.join(KP_DEFAULTS)}",
+    )
+    parser.add_argument("--output", help="JSON file to write results to")
+    args = parser.parse_args()
+
+    kp_config = {**KP_DEFAULTS, **parse_settings(parser, args.kp)}
+    if unknown := set(kp_config) - set(KP_DEFAULTS):
+        parser.error(f"unknown KP settings {', '.join(sorted(unknown))}")
+    variants = {"default": {}, **parse_settings(parser, args.variant)}
+    records = read_capture(args.capture)[:args.limit]
+    if not records:
+        parser.error(f"{args.capture} holds no queries")
+
+    report = {"capture": args.capture, "speed": args.speed, "kp": kp_config, "variants": dict()}
+    print(f"{'variant':<16} {'q/s':>7} {'p50 (s)':>8} {'p99 (s)':>8} {'eff':>6} {'429s':>5} {'fail':>5}")
+    for name, kp_settings in variants.items():
+        results = asyncio.run(replay(records, kp_config, kp_settings, args.speed))
+        report["variants"][name] = {"settings": kp_settings, "results": results}
+        print(
+            f"{name:<16} {results['throughput']:>7.1f} {results['latency_p50']:>8.3f} "
+            f"{results['latency_p99']:>8.3f} {results['kp_call_efficiency']:>6.1f} "
+            f"{results['kp_429s']:>5} {results['failures']:>5}"
+        )
+        for kp_id, kp in results["kps"].items():
+            stats = kp["batch_stats"]
+            print(
+                f"  {kp_id:<14} {kp['queries']:>6} queries {kp['kp_calls']:>5} KP calls "
+                f"{stats['mean_subrequests']:>6.1f} sub-requests/batch {stats['mean_linger']:>7.3f} s linger"
+            )
+
+    default = report["variants"]["default"]["results"]
+    if len(variants) > 1:
+        print("\nchange from default")
+    for name, variant in report["variants"].items():
+        if name == "default":
+            continue
+        print(f"{name:<16}", " ".join(
+            f"{key} {relative_change(default[key], variant['results'][key]):+.1%}"
+            for key in COMPARED
+        ))
+
+    if args.output:
+        with open(args.output, "w") as stream:
+            json.dump(report, stream, indent=2)
+
+
+if __name__ == "__main__":
+    main()
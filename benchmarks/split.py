@@ -0,0 +1,57 @@
+"""
+Benchmark splitting a merged KP response into sub-responses.
+
+Compares scanning every result for each sub-request with
+looking sub-requests up in an index of the results.
+
+Usage: python -m benchmarks.split
+"""
+import time
+
+from trapi_throttle.trapi import filter_by_curie_mapping, index_results
+
+from .synthetic import merged_message
+
+CASES = [
+    # (curies, results per curie)
+    (10, 100),
+    (100, 100),
+    (100, 300),
+    (300, 100),
+]
+
+
+def split(message, curie_mappings, use_index: bool):
+    """Split the message for every sub-request."""
+    index = index_results(message["results"]) if use_index else None
+    return {
+        request_id: filter_by_curie_mapping(message, curie_mapping, index=index)
+        for request_id, curie_mapping in curie_mappings.items()
+    }
+
+
+def timed(fcn, *args, repeat: int = 3) -> float:
+    """Best wall time of fcn(*args) in seconds."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fcn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    print(f"{'curies':>7} {'results':>8} {'scan (s)':>10} {'index (s)':>10} {'speedup':>8}")
+    for n_curies, results_per_curie in CASES:
+        message, curie_mappings = merged_message(n_curies, results_per_curie)
+        assert split(message, curie_mappings, False) == split(message, curie_mappings, True)
+        scan = timed(split, message, curie_mappings, False)
+        indexed = timed(split, message, curie_mappings, True)
+        print(
+            f"{n_curies:>7} {len(message['results']):>8} "
+            f"{scan:>10.4f} {indexed:>10.4f} {scan / indexed:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""Synthetic TRAPI messages for benchmarking."""
+import random
+
+
+def merged_message(
+        n_curies: int,
+        results_per_curie: int,
+        seed: int = 0,
+) -> tuple[dict, dict[str, dict[str, list[str]]]]:
+    """
+    Build a one-hop response to a merged request with n_curies pinned curies.
+
+    Returns the message and the curie mapping of each sub-request
+    (one curie per sub-request).
+    """
+    rng = random.Random(seed)
+    n_objects = max(1, n_curies * results_per_curie // 2)
+    nodes = {
+        f"MONDO:{index}": {"categories": ["biolink:Disease"]}
+        for index in range(n_objects)
+    }
+    edges = dict()
+    results = []
+    for curie_index in range(n_curies):
+        curie = f"CHEBI:{curie_index}"
+        nodes[curie] = {"categories": ["biolink:ChemicalSubstance"]}
+        for _ in range(results_per_curie):
+            obj = f"MONDO:{rng.randrange(n_objects)}"
+            edge_id = f"e{len(edges)}"
+            edges[edge_id] = {
+                "subject": curie,
+                "object": obj,
+                "predicate": "biolink:treats",
+            }
+            results.append({
+                "node_bindings": {
+                    "n0": [{"id": curie}],
+                    "n1": [{"id": obj}],
+                },
+                "edge_bindings": {
+                    "n0n1": [{"id": edge_id}],
+                },
+            })
+    message = {
+        "query_graph": {
+            "nodes": {
+                "n0": {"ids": [f"CHEBI:{index}" for index in range(n_curies)]},
+                "n1": {"categories": ["biolink:Disease"]},
+            },
+            "edges": {
+                "n0n1": {
+                    "subject": "n0",
+                    "object": "n1",
+                    "predicates": ["biolink:treats"],
+                },
+            },
+        },
+        "knowledge_graph": {"nodes": nodes, "edges": edges},
+        "results": results,
+    }
+    curie_mappings = {
+        f"request{index}": {"n0": [f"CHEBI:{index}"]}
+        for index in range(n_curies)
+    }
+    return message, curie_mappings
+
+
+def synthetic_message(
+        n_nodes: int,
+        n_edges: int,
+        n_results: int,
+        fan_out: int = 1,
+        n_curies: int = 10,
+        seed: int = 0,
+) -> tuple[dict, dict[str, dict[str, list[str]]]]:
+    """
+    Build a one-hop response with the given numbers of knowledge graph
+    nodes and edges and results.
+
+    The first n_curies nodes are pinned on qnode n0. Each result binds
+    every qnode and qedge to fan_out random knowledge graph elements,
+    so nodes and edges that no result binds are left in the knowledge
+    graph. Returns the message and the curie mapping of each sub-request
+    (one curie per sub-request).
+    """
+    rng = random.Random(seed)
+    n_curies = min(n_curies, n_nodes)
+    nodes = {
+        f"CHEBI:{index}": {"categories": ["biolink:ChemicalSubstance"]}
+        for index in range(n_curies)
+    }
+    nodes.update(
+        (f"MONDO:{index}", {"categories": ["biolink:Disease"]})
+        for index in range(n_nodes - n_curies)
+    )
+    curies = list(nodes)[:n_curies]
+    objects = list(nodes)[n_curies:] or curies
+    edges = {
+        f"e{index}": {
+            "subject": rng.choice(curies),
+            "object": rng.choice(objects),
+            "predicate": "biolink:treats",
+        }
+        for index in range(n_edges)
+    }
+    edge_ids = list(edges)
+    results = [
+        {
+            "node_bindings": {
+                "n0": [{"id": curie} for curie in rng.sample(curies, min(fan_out, len(curies)))],
+                "n1": [{"id": obj} for obj in rng.sample(objects, min(fan_out, len(objects)))],
+            },
+            "edge_bindings": {
+                "n0n1": [{"id": edge_id} for edge_id in rng.sample(edge_ids, min(fan_out, len(edge_ids)))],
+            },
+        }
+        for _ in range(n_results)
+    ]
+    message = {
+        "query_graph": {
+            "nodes": {
+                "n0": {"ids": curies},
+                "n1": {"categories": ["biolink:Disease"]},
+            },
+            "edges": {
+                "n0n1": {
+                    "subject": "n0",
+                    "object": "n1",
+                    "predicates": ["biolink:treats"],
+                },
+            },
+        },
+        "knowledge_graph": {"nodes": nodes, "edges": edges},
+        "results": results,
+    }
+    curie_mappings = {
+        f"request{index}": {"n0": [curie]}
+        for index, curie in enumerate(curies)
+    }
+    return message, curie_mappings
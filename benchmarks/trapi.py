@@ -0,0 +1,125 @@
+"""
+Microbenchmarks of the merge/split functions in trapi_throttle.trapi.
+
+Times each function on synthetic messages of several sizes and
+records its peak allocations (tracemalloc), so that optimizations of
+the batching hot path can be measured one function at a time.
+
+Usage: python -m benchmarks.trapi [--output FILE]
+"""
+import argparse
+import copy
+import json
+import time
+import tracemalloc
+
+from trapi_throttle.trapi import (
+    filter_by_curie_mapping,
+    get_curies,
+    index_results,
+    remove_curies,
+    remove_unbound_from_kg,
+    result_contains_node_bindings,
+)
+
+from .synthetic import synthetic_message
+
+CASES = [
+    # (nodes, edges, results, fan-out, curies)
+    (1000, 1000, 1000, 1, 10),
+    (10000, 10000, 10000, 1, 50),
+    (10000, 20000, 10000, 3, 50),
+    (50000, 50000, 50000, 1, 20),
+]
+
+
+def contains_all(message, curie_mappings):
+    """Check every result against every curie mapping."""
+    for curie_mapping in curie_mappings.values():
+        for result in message["results"]:
+            result_contains_node_bindings(result, curie_mapping)
+
+
+def filter_all(message, curie_mappings, index=None):
+    """Filter the message for every curie mapping."""
+    for curie_mapping in curie_mappings.values():
+        filter_by_curie_mapping(message, curie_mapping, index=index)
+
+
+def remove_unbound(message):
+    """Remove unbound elements from a copy of the message's knowledge graph."""
+    message = {**message, "knowledge_graph": dict(message["knowledge_graph"])}
+    remove_unbound_from_kg(message)
+
+
+# name -> function of (message, curie mappings)
+BENCHMARKS = {
+    "get_curies": lambda message, _: get_curies(message["query_graph"]),
+    "remove_curies": lambda message, _: remove_curies(message["query_graph"]),
+    "remove_unbound_from_kg": lambda message, _: remove_unbound(message),
+    "result_contains_node_bindings": contains_all,
+    "filter_by_curie_mapping": filter_all,
+    "filter_by_curie_mapping[index]": lambda message, curie_mappings: filter_all(
+        message, curie_mappings, index_results(message["results"]),
+    ),
+}
+
+
+def measure(fcn, *args, repeat: int = 3) -> tuple[float, int]:
+    """
+    Best wall time of fcn(*args) in seconds, and its peak
+    allocations in bytes.
+
+    The allocations are traced in a separate run so that
+    tracing does not slow down the timed ones.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fcn(*args)
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        fcn(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return best, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--output", help="JSON file to write results to")
+    args = parser.parse_args()
+
+    report = []
+    print(f"{'function':<32} {'nodes':>6} {'edges':>6} {'results':>7} {'fan':>4} {'curies':>6} {'time (s)':>9} {'peak (MB)':>10}")
+    for n_nodes, n_edges, n_results, fan_out, n_curies in CASES:
+        message, curie_mappings = synthetic_message(n_nodes, n_edges, n_results, fan_out, n_curies)
+        pristine = copy.deepcopy(message)
+        for name, fcn in BENCHMARKS.items():
+            seconds, peak = measure(fcn, message, curie_mappings)
+            assert message == pristine, f"{name} modified its input"
+            report.append({
+                "function": name,
+                "nodes": n_nodes,
+                "edges": n_edges,
+                "results": n_results,
+                "fan_out": fan_out,
+                "curies": n_curies,
+                "seconds": seconds,
+                "peak_bytes": peak,
+            })
+            print(
+                f"{name:<32} {n_nodes:>6} {n_edges:>6} {n_results:>7} {fan_out:>4} {n_curies:>6} "
+                f"{seconds:>9.4f} {peak / 1e6:>10.2f}"
+            )
+
+    if args.output:
+        with open(args.output, "w") as stream:
+            json.dump(report, stream, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -14,6 +14,12 @@ setup(
         "httpx>=0.18.0",
         "reasoner-pydantic>=1.1.2.1,<1.1.3",
     ],
+    extras_require={
+        "http2": ["httpx[http2]>=0.18.0"],
+        "orjson": ["orjson>=3.5"],
+        "streaming": ["ijson>=3.1"],
+        "tracing": ["opentelemetry-api>=1.0"],
+    },
     zip_safe=False,
     license="MIT",
     python_requires=">=3.9",
@@ -0,0 +1,40 @@
+"""Test result cache."""
+import time
+
+from trapi_throttle.cache import ResultCache
+
+
+def test_lru():
+    """Test that the least recently used entry is evicted."""
+    cache = ResultCache(2, 60)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+
+    assert "a" in cache
+    assert "b" not in cache
+    assert "c" in cache
+    assert len(cache) == 2
+
+
+def test_ttl():
+    """Test that entries expire."""
+    cache = ResultCache(2, 0.05)
+    cache.put("a", 1)
+    assert cache.get("a") == 1
+    time.sleep(0.1)
+    assert "a" not in cache
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+def test_hits_and_misses():
+    """Test that lookups are counted."""
+    cache = ResultCache(2, 60)
+    cache.put("a", 1)
+    cache.get("a")
+    cache.get("b")
+    # checking membership does not count
+    assert "a" in cache
+    assert (cache.hits, cache.misses) == (1, 1)
@@ -0,0 +1,40 @@
+"""Test query capture."""
+import asyncio
+
+import pytest
+
+from trapi_throttle.capture import Capture, read_capture
+
+
+@pytest.mark.asyncio
+async def test_capture(tmp_path):
+    """Test that captured queries are read back in arrival order."""
+    path = str(tmp_path / "capture.jsonl")
+    capture = Capture(path)
+    capture.record("kp1", {"message": {"query_graph": {"nodes": {}, "edges": {}}}})
+    capture.record("kp2", {"message": {}})
+    await capture.close()
+
+    # appending keeps earlier records
+    capture = Capture(path)
+    capture.record("kp1", {"message": {}})
+    await capture.close()
+
+    records = read_capture(path)
+    assert [kp_id for _, kp_id, _ in records] == ["kp1", "kp2", "kp1"]
+    assert records[0][2] == {"message": {"query_graph": {"nodes": {}, "edges": {}}}}
+    assert records[0][0] <= records[1][0] <= records[2][0]
+
+
+@pytest.mark.asyncio
+async def test_capture_buffered(tmp_path):
+    """Test that records are written in the background."""
+    path = str(tmp_path / "capture.jsonl")
+    capture = Capture(path, flush_interval=0.1)
+    capture.record("kp1", {"message": {}})
+    assert read_capture(path) == []
+    await asyncio.sleep(0.3)
+    assert len(read_capture(path)) == 1
+    capture.record("kp2", {"message": {}})
+    await capture.close()
+    assert [kp_id for _, kp_id, _ in read_capture(path)] == ["kp1", "kp2"]
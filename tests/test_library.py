@@ -4,6 +4,7 @@ import copy
 import datetime
 import time
 
+from trapi_throttle.cache import ResultCache
 from trapi_throttle.trapi import BatchingError
 
 from reasoner_pydantic.message import Query
@@ -452,3 +453,380 @@ async def test_max_batch_size():
     # if we sent at most one subquery at a time and waited one second between
     # subqueries, it took at least one second
     assert elapsed > 1
+
+
+@pytest.mark.asyncio
+@with_kp_overlay(
+    "http://kp1/query",
+    kp_data="""
+        MONDO:0005148(( category biolink:Disease ))
+        CHEBI:6801(( category biolink:ChemicalSubstance ))
+        CHEBI:6801-- predicate biolink:treats -->MONDO:0005148
+        CHEBI:6802(( category biolink:ChemicalSubstance ))
+        CHEBI:6802-- predicate biolink:treats -->MONDO:0005148
+        CHEBI:6803(( category biolink:ChemicalSubstance ))
+        CHEBI:6803-- predicate biolink:treats -->MONDO:0005148
+        """,
+    request_qty=3,
+    request_duration=datetime.timedelta(seconds=1)
+)
+async def test_linger():
+    """Test that lingering collects requests arriving a little apart."""
+
+    kp_info = {
+        "url": "http://kp1/query",
+        "request_qty": 0,
+        "request_duration": 1,
+    }
+
+    curies = ["CHEBI:6801", "CHEBI:6802", "CHEBI:6803"]
+
+    async def delayed_query(server, index):
+        await asyncio.sleep(0.05 * index)
+        qg = copy.deepcopy(QG)
+        qg["nodes"]["n0"]["ids"] = [curies[index]]
+        qg["edges"]["n0n1"]["predicates"] = ["biolink:treats"]
+        return await server.query({"message": {"query_graph": qg}})
+
+    async with ThrottledServer(
+        "kp1",
+        **kp_info,
+        linger=0.5,
+    ) as server:
+        msgs = await asyncio.wait_for(
+            asyncio.gather(
+                *(
+                    delayed_query(server, index)
+                    for index in range(len(curies))
+                )
+            ),
+            timeout=20,
+        )
+        stats = server.batch_stats()
+
+    assert stats["batches"] == 1
+    assert stats["mean_subrequests"] == 3
+    for curie, msg in zip(curies, msgs):
+        assert len(msg["message"]["results"]) == 1
+        assert msg["message"]["results"][0]["node_bindings"]["n0"][0]["id"] == curie
+
+
+@pytest.mark.asyncio
+@with_kp_overlay(
+    "http://kp1/query",
+    kp_data="""
+        MONDO:0005148(( category biolink:Disease ))
+        CHEBI:6801(( category biolink:ChemicalSubstance ))
+        CHEBI:6801-- predicate biolink:treats -->MONDO:0005148
+        """,
+    request_qty=1,
+    request_duration=datetime.timedelta(seconds=1)
+)
+async def test_coalesce():
+    """Test that identical concurrent queries share one subrequest."""
+
+    kp_info = {
+        "url": "http://kp1/query",
+        "request_qty": 1,
+        "request_duration": 1,
+    }
+
+    qg = copy.deepcopy(QG)
+    qg["edges"]["n0n1"]["predicates"] = ["biolink:treats"]
+
+    async with ThrottledServer("kp1", **kp_info) as server:
+        msgs = await asyncio.wait_for(
+            asyncio.gather(
+                *(
+                    server.query({"message": {"query_graph": qg}})
+                    for _ in range(5)
+                )
+            ),
+            timeout=20,
+        )
+        stats = server.batch_stats()
+
+    # the KP allows one request per second, so all
+    # five queries must have been answered by one request
+    assert stats["batches"] == 1
+    assert stats["mean_subrequests"] == 1
+    for msg in msgs:
+        validate_message(
+            {
+                "knowledge_graph":
+                    """
+                    CHEBI:6801 biolink:treats MONDO:0005148
+                    """,
+                "results": [
+                    """
+                    node_bindings:
+                        n0 CHEBI:6801
+                        n1 MONDO:0005148
+                    edge_bindings:
+                        n0n1 CHEBI:6801-MONDO:0005148
+                    """
+                ],
+            },
+            msg["message"]
+        )
+
+
+@pytest.mark.asyncio
+@with_response_overlay(
+    "http://kp1/query",
+    response={"message": {
+        "knowledge_graph": {"nodes": {}, "edges": {}},
+        "query_graph": QG,
+        "results": [],
+    }},
+    request_qty=5,
+    request_duration=datetime.timedelta(seconds=1),
+)
+async def test_drop_abandoned():
+    """Test that requests whose callers gave up are not sent."""
+    kp_info = {
+        "url": "http://kp1/query",
+        "request_qty": 1,
+        "request_duration": 1,
+    }
+
+    def query(predicate):
+        qg = copy.deepcopy(QG)
+        qg["edges"]["n0n1"]["predicates"] = [predicate]
+        return {"message": {"query_graph": qg}}
+
+    async with ThrottledServer("kp1", **kp_info) as server:
+        first = asyncio.create_task(server.query(query("biolink:treats")))
+        await asyncio.sleep(0.1)
+        # each shape would get its own batch, after the first one's
+        abandoned = [
+            server.query(query(f"biolink:predicate{index}"), timeout=0.5)
+            for index in range(3)
+        ]
+        for result in await asyncio.gather(*abandoned, return_exceptions=True):
+            assert isinstance(result, asyncio.TimeoutError)
+        last = await server.query(query("biolink:affects"), timeout=5)
+        await first
+        stats = server.batch_stats()
+
+    assert last["message"]["results"] == []
+    assert stats["batches"] == 2
+    assert server.metrics.dropped.value == 3
+
+
+@pytest.mark.asyncio
+@with_response_overlay(
+    "http://kp1/query",
+    response={"message": {
+        "knowledge_graph": {"nodes": {}, "edges": {}},
+        "query_graph": QG,
+        "results": [],
+    }},
+    request_qty=5,
+    request_duration=datetime.timedelta(seconds=1),
+    delay=10.0,
+)
+async def test_cancel_in_flight():
+    """Test that the KP request is cancelled when all callers leave."""
+    kp_info = {
+        "url": "http://kp1/query",
+        "request_qty": 5,
+        "request_duration": 1,
+    }
+
+    async with ThrottledServer("kp1", **kp_info) as server:
+        tasks = [
+            asyncio.create_task(server.query({"message": {"query_graph": QG}}))
+            for _ in range(2)
+        ]
+        await asyncio.sleep(0.5)
+        assert server.batch_stats()["batches"] == 1
+
+        # the batch goes on while anyone waits
+        tasks[0].cancel()
+        await asyncio.sleep(0.1)
+        assert server.metrics.abandoned.value == 0
+        tasks[1].cancel()
+        await asyncio.sleep(0.1)
+        assert server.metrics.abandoned.value == 1
+        assert not server.pending
+
+
+@pytest.mark.asyncio
+@with_response_overlay(
+    "http://kp1/query",
+    response={"message": {
+        "knowledge_graph": {"nodes": {}, "edges": {}},
+        "query_graph": QG,
+        "results": [],
+    }},
+    request_qty=5,
+    request_duration=datetime.timedelta(seconds=1),
+)
+async def test_failed_batch():
+    """Test that unexpected errors reach every caller of a batch."""
+    kp_info = {
+        "url": "http://kp1/query",
+        "request_qty": 5,
+        "request_duration": 1,
+    }
+    failures = 1
+
+    async def postproc(response):
+        nonlocal failures
+        if failures:
+            failures -= 1
+            raise KeyError("node_bindings")
+        return response
+
+    async with ThrottledServer("kp1", **kp_info, postproc=postproc) as server:
+        results = await asyncio.wait_for(
+            asyncio.gather(
+                *(server.query({"message": {"query_graph": QG}}) for _ in range(2)),
+                return_exceptions=True,
+            ),
+            timeout=5,
+        )
+        for result in results:
+            assert isinstance(result, BatchingError)
+            assert isinstance(result.__cause__, KeyError)
+        assert not server.pending
+
+        # identical queries are not attached to the failed request
+        response = await server.query({"message": {"query_graph": QG}}, timeout=5)
+    assert response["message"]["results"] == []
+
+
+@pytest.mark.asyncio
+async def test_streaming_validation():
+    """Test that streamed responses are not copied by full validation."""
+    pytest.importorskip("ijson")
+    response = {"message": {
+        "query_graph": QG,
+        "knowledge_graph": {"nodes": {}, "edges": {}},
+        "results": [],
+    }}
+    server = ThrottledServer("kp1", "http://kp1/query", 1, 1, streaming=True)
+    assert server.validation == "full"
+    assert server.validate(response) is response
+
+
+@pytest.mark.asyncio
+@with_response_overlay(
+    "http://kp1/query",
+    response={"message": {
+        "knowledge_graph": {"nodes": {}, "edges": {}},
+        "query_graph": QG,
+        "results": [],
+    }},
+    request_qty=5,
+    request_duration=datetime.timedelta(seconds=1),
+    delay=0.3,
+)
+async def test_promote_deferred():
+    """Test that a deferred request goes back in line for a follower with time left."""
+    kp_info = {
+        "url": "http://kp1/query",
+        "request_qty": 1,
+        "request_duration": 1,
+    }
+
+    def query(predicate):
+        qg = copy.deepcopy(QG)
+        qg["edges"]["n0n1"]["predicates"] = [predicate]
+        return {"message": {"query_graph": qg}}
+
+    async with ThrottledServer("kp1", **kp_info) as server:
+        # learn the KP latency
+        await server.query(query("biolink:related_to"))
+        start = time.monotonic()
+        # too little time left to wait for the KP
+        hurried = asyncio.create_task(server.query(query("biolink:treats"), timeout=0.2))
+        await asyncio.sleep(0.05)
+        assert server.metrics.deferred.value == 1
+        other = asyncio.create_task(server.query(query("biolink:affects"), timeout=5))
+        await asyncio.sleep(0.05)
+        follower = await server.query(query("biolink:treats"), timeout=5)
+        finished = time.monotonic() - start
+        await other
+        with pytest.raises(asyncio.TimeoutError):
+            await hurried
+
+    assert follower["message"]["results"] == []
+    # sent in the next rate slot, ahead of the later query
+    assert finished < 1.5
+
+
+@pytest.mark.asyncio
+@with_response_overlay(
+    "http://kp1/query",
+    response={"message": {
+        "knowledge_graph": {"nodes": {}, "edges": {}},
+        "query_graph": QG,
+        "results": [],
+    }},
+    request_qty=5,
+    request_duration=datetime.timedelta(seconds=1),
+)
+async def test_linger_rate_limited():
+    """Test that lingering adds no latency on top of the rate limit."""
+    kp_info = {
+        "url": "http://kp1/query",
+        "request_qty": 1,
+        "request_duration": 1,
+    }
+
+    def query(curie):
+        qg = copy.deepcopy(QG)
+        qg["nodes"]["n0"]["ids"] = [curie]
+        return {"message": {"query_graph": qg}}
+
+    async with ThrottledServer("kp1", **kp_info, linger=0.5) as server:
+        await server.query(query("CHEBI:6801"))
+        # the next rate slot is about a second away
+        start = time.monotonic()
+        first = asyncio.create_task(server.query(query("CHEBI:6802")))
+        # arrives after the linger window, before the rate slot
+        await asyncio.sleep(0.7)
+        await server.query(query("CHEBI:6803"))
+        await first
+        elapsed = time.monotonic() - start
+        stats = server.batch_stats()
+
+    # sent in the rate slot, with both requests
+    assert elapsed < 1.2
+    assert stats["batches"] == 2
+    assert stats["mean_subrequests"] == 1.5
+
+
+@pytest.mark.asyncio
+@with_response_overlay(
+    "http://kp1/query",
+    response={"message": {
+        "knowledge_graph": {"nodes": {}, "edges": {}},
+        "query_graph": QG,
+        "results": [],
+    }},
+    request_qty=5,
+    request_duration=datetime.timedelta(seconds=1),
+)
+async def test_cache_expiring():
+    """Test that a cache entry expiring during lookup sends the query to the KP."""
+    kp_info = {
+        "url": "http://kp1/query",
+        "request_qty": 5,
+        "request_duration": 1,
+    }
+
+    class ExpiringCache(ResultCache):
+        def __contains__(self, key):
+            # live when checked, gone when fetched
+            return True
+
+    async with ThrottledServer("kp1", **kp_info, cache_size=10) as server:
+        server.cache = ExpiringCache(10, 60)
+        response = await server.query({"message": {"query_graph": QG}}, timeout=5)
+        stats = server.batch_stats()
+
+    assert response["message"]["results"] == []
+    assert stats["batches"] == 1
@@ -0,0 +1,368 @@
+"""Test rate limiters."""
+import asyncio
+from contextlib import asynccontextmanager
+import datetime
+import time
+
+import pytest
+
+from trapi_throttle.limiter import (
+    GCRALimiter,
+    RedisGCRALimiter,
+    SharedGCRALimiter,
+    make_limiter,
+)
+from trapi_throttle.resp import RESPClient, encode_command, read_reply
+from trapi_throttle.utils import parse_retry_after
+
+
+@pytest.mark.asyncio
+async def test_gcra_spacing():
+    """Test that requests are spaced one interval apart."""
+    limiter = GCRALimiter(4, datetime.timedelta(seconds=1))
+    start = time.monotonic()
+    for _ in range(3):
+        await limiter.acquire()
+    elapsed = time.monotonic() - start
+    # the first request goes out right away
+    assert 0.45 < elapsed < 0.7
+
+
+@pytest.mark.asyncio
+async def test_gcra_concurrent():
+    """Test that concurrent callers share the rate limit."""
+    limiter = GCRALimiter(10, datetime.timedelta(seconds=1))
+    start = time.monotonic()
+    await asyncio.gather(*(limiter.acquire() for _ in range(5)))
+    elapsed = time.monotonic() - start
+    assert 0.35 < elapsed < 0.6
+
+
+@pytest.mark.asyncio
+async def test_gcra_unlimited():
+    """Test that a request_qty of 0 disables the rate limit."""
+    limiter = GCRALimiter(0, datetime.timedelta(seconds=1))
+    start = time.monotonic()
+    for _ in range(100):
+        await limiter.acquire()
+    assert time.monotonic() - start < 0.1
+
+
+@pytest.mark.asyncio
+async def test_gcra_burst():
+    """Test that GCRA tolerance lets a burst through after idling."""
+    limiter = GCRALimiter(10, datetime.timedelta(seconds=1), burst=3)
+    start = time.monotonic()
+    for _ in range(3):
+        await limiter.acquire()
+    assert time.monotonic() - start < 0.05
+
+    # then requests are spaced again
+    await limiter.acquire()
+    assert time.monotonic() - start > 0.05
+
+
+@pytest.mark.asyncio
+async def test_token_bucket():
+    """Test that a token bucket starts full and then refills."""
+    limiter = make_limiter("token_bucket", 5, datetime.timedelta(seconds=1))
+    start = time.monotonic()
+    for _ in range(5):
+        await limiter.acquire()
+    assert time.monotonic() - start < 0.05
+
+    await limiter.acquire()
+    assert 0.15 < time.monotonic() - start < 0.3
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_penalize():
+    """Test that penalizing empties the bucket and halves the rate."""
+    limiter = make_limiter("token_bucket", 5, datetime.timedelta(seconds=1))
+    limiter.penalize()
+    start = time.monotonic()
+    await limiter.acquire()
+    assert 0.35 < time.monotonic() - start < 0.5
+
+
+@pytest.mark.asyncio
+async def test_next_slot(tmp_path):
+    """Test that next_slot tells when acquire lets a request through."""
+    limiters = [
+        make_limiter("gcra", 5, datetime.timedelta(seconds=1)),
+        make_limiter("token_bucket", 5, datetime.timedelta(seconds=1), burst=1),
+        make_limiter("gcra", 5, datetime.timedelta(seconds=1), state_file=str(tmp_path / "kp.gcra")),
+    ]
+    for limiter in limiters:
+        start = time.monotonic()
+        assert limiter.next_slot() - start < 0.01
+        await limiter.acquire()
+        # looking does not take the slot
+        for _ in range(2):
+            assert 0.15 < limiter.next_slot() - start < 0.25
+        await limiter.acquire()
+        assert 0.15 < time.monotonic() - start < 0.25
+        limiter.close()
+
+
+@pytest.mark.asyncio
+async def test_refund():
+    """Test that a refunded slot can be used right away."""
+    for mode in ("gcra", "token_bucket"):
+        limiter = make_limiter(mode, 2, datetime.timedelta(seconds=1), burst=1)
+        start = time.monotonic()
+        await limiter.acquire()
+        limiter.refund()
+        await limiter.acquire()
+        assert time.monotonic() - start < 0.05
+
+
+@pytest.mark.asyncio
+async def test_retry_after():
+    """Test that penalizing holds off for Retry-After seconds."""
+    for mode in ("gcra", "token_bucket"):
+        limiter = make_limiter(mode, 100, datetime.timedelta(seconds=1))
+        limiter.penalize(0.3)
+        start = time.monotonic()
+        await limiter.acquire()
+        assert 0.25 < time.monotonic() - start < 0.45
+
+
+def test_aimd():
+    """Test that the rate is cut on 429s and recovers additively."""
+    limiter = GCRALimiter(10, datetime.timedelta(seconds=1))
+    # 429s within a request_duration cut the rate once
+    limiter.penalize()
+    limiter.penalize()
+    assert limiter.rate == 5
+    limiter.slowed_at -= 1
+    limiter.penalize()
+    assert limiter.rate == 2.5
+    assert limiter.interval == 0.4
+    for _ in range(3):
+        limiter.recover()
+    assert limiter.rate == 5.5
+    for _ in range(10):
+        limiter.recover()
+    assert limiter.stats() == {"rate": 10, "max_rate": 10, "penalties": 3}
+
+    # never below one request per request_duration
+    for _ in range(10):
+        limiter.slowed_at -= 1
+        limiter.penalize()
+    assert limiter.rate == 1
+
+
+def test_parse_retry_after():
+    """Test parsing Retry-After seconds and HTTP dates."""
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("120") == 120
+    assert parse_retry_after("soon") is None
+    assert parse_retry_after("inf") is None
+    assert parse_retry_after("nan") is None
+    assert parse_retry_after("-5") == 0
+    assert parse_retry_after("86400", max_delay=60) == 60
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0
+    date = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=30)
+    retry_after = parse_retry_after(date.strftime("%a, %d %b %Y %H:%M:%S GMT"))
+    assert 25 < retry_after <= 30
+
+
+@pytest.mark.asyncio
+async def test_shared_gcra(tmp_path):
+    """Test that limiters sharing a state file share the rate limit."""
+    path = str(tmp_path / "kp.gcra")
+    limiters = [
+        make_limiter("gcra", 10, datetime.timedelta(seconds=1), state_file=path)
+        for _ in range(2)
+    ]
+    assert all(isinstance(limiter, SharedGCRALimiter) for limiter in limiters)
+    start = time.monotonic()
+    for _ in range(3):
+        for limiter in limiters:
+            await limiter.acquire()
+    # six requests, the first one right away
+    assert 0.45 < time.monotonic() - start < 0.7
+
+    # a 429 seen by one holds off the other
+    limiters[0].penalize(0.3)
+    start = time.monotonic()
+    await limiters[1].acquire()
+    assert 0.25 < time.monotonic() - start < 0.45
+
+    for limiter in limiters:
+        limiter.close()
+    with pytest.raises(ValueError):
+        make_limiter("token_bucket", 10, datetime.timedelta(seconds=1), state_file=path)
+
+
+@pytest.mark.asyncio
+async def test_shared_gcra_clamp(tmp_path):
+    """Test that a TAT far in the future, e.g. from another host, is clamped."""
+    path = str(tmp_path / "kp.gcra")
+    with open(path, "wb") as stream:
+        stream.write(SharedGCRALimiter.STATE.pack(time.time() + 86400))
+    limiter = make_limiter("gcra", 10, datetime.timedelta(seconds=0.2), state_file=path)
+    start = time.monotonic()
+    await limiter.acquire()
+    # at most burst intervals plus request_duration
+    assert time.monotonic() - start < 0.35
+    limiter.close()
+
+
+@asynccontextmanager
+async def gcra_server():
+    """
+    Serve the Redis protocol on a local port, answering EVAL
+    the way GCRA_SCRIPT would on a real server.
+    """
+    tats = dict()
+    evals = []
+    handlers = set()
+
+    async def handle(reader, writer):
+        handlers.add(asyncio.current_task())
+        while True:
+            try:
+                command = await read_reply(reader)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                break
+            if command[0].upper() != b"EVAL":
+                writer.write(b"-ERR unknown command\r\n")
+                continue
+            key = command[3]
+            interval, tolerance, count, hold = map(int, command[4:8])
+            evals.append(key)
+            now = int(time.monotonic() * 1e6)
+            tat = max(tats.get(key, now), now)
+            if hold >= 0:
+                tat = max(tat, now + hold + tolerance)
+            tats[key] = tat + count * interval
+            writer.write(b":%d\r\n" % (tat - tolerance - now))
+        writer.close()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    try:
+        yield f"redis://127.0.0.1:{port}/0", evals
+    finally:
+        server.close()
+        await server.wait_closed()
+        for handler in handlers:
+            handler.cancel()
+        await asyncio.gather(*handlers, return_exceptions=True)
+
+
+def redis_limiter(url: str, lease: int = 1) -> RedisGCRALimiter:
+    return make_limiter(
+        "gcra", 10, datetime.timedelta(seconds=1),
+        state_url=url, key="trapi_throttle:kp", lease=lease,
+    )
+
+
+@pytest.mark.asyncio
+async def test_redis_gcra():
+    """Test that limiters sharing a server share the rate limit."""
+    async with gcra_server() as (url, evals):
+        limiters = [redis_limiter(url) for _ in range(2)]
+        start = time.monotonic()
+        for _ in range(3):
+            for limiter in limiters:
+                await limiter.acquire()
+        assert 0.45 < time.monotonic() - start < 0.7
+        assert len(evals) == 6
+
+        # a 429 seen by one is passed on with its next request
+        # and holds off the other
+        limiters[0].penalize(0.3)
+        start = time.monotonic()
+        await limiters[0].acquire()
+        await limiters[1].acquire()
+        # the penalized limiter reserved a slot at half the rate
+        assert 0.45 < time.monotonic() - start < 0.7
+        for limiter in limiters:
+            limiter.close()
+
+
+@pytest.mark.asyncio
+async def test_redis_gcra_lease():
+    """Test that leased slots are handed out without round trips."""
+    async with gcra_server() as (url, evals):
+        limiter = redis_limiter(url, lease=3)
+        start = time.monotonic()
+        for _ in range(3):
+            await limiter.acquire()
+        assert 0.15 < time.monotonic() - start < 0.3
+        assert len(evals) == 1
+        assert limiter.stats()["leased"] == 0
+
+        # the lease was reserved on the server
+        other = redis_limiter(url)
+        await other.acquire()
+        assert 0.25 < time.monotonic() - start < 0.4
+        limiter.close()
+        other.close()
+
+
+@pytest.mark.asyncio
+async def test_redis_gcra_unavailable(unused_tcp_port):
+    """Test that the limiter falls back to limiting locally."""
+    limiter = redis_limiter(f"redis://127.0.0.1:{unused_tcp_port}")
+    start = time.monotonic()
+    for _ in range(3):
+        await limiter.acquire()
+    assert 0.15 < time.monotonic() - start < 0.3
+
+
+@pytest.mark.asyncio
+async def test_redis_gcra_hung():
+    """Test that the limiter falls back when the server does not answer."""
+    connections = []
+
+    async def handle(reader, writer):
+        connections.append(writer)
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    limiter = make_limiter(
+        "gcra", 10, datetime.timedelta(seconds=1),
+        state_url=f"redis://127.0.0.1:{port}", state_timeout=0.1,
+    )
+    start = time.monotonic()
+    await limiter.acquire()
+    assert 0.1 <= time.monotonic() - start < 0.2
+    # the connection was given up
+    assert limiter.client.writer is None
+    limiter.close()
+    server.close()
+    for writer in connections:
+        writer.close()
+    await server.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_resp_client():
+    """Test encoding commands and reading replies."""
+    assert encode_command("GET", b"key", 1) == b"*3\r\n$3\r\nGET\r\n$3\r\nkey\r\n$1\r\n1\r\n"
+
+    async def handle(reader, writer):
+        await read_reply(reader)
+        writer.write(b"*4\r\n+OK\r\n:42\r\n$5\r\nhello\r\n$-1\r\n-ERR oops\r\n")
+        await writer.drain()
+        writer.close()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    client = RESPClient(f"redis://127.0.0.1:{port}")
+    assert await client.execute("PING") == [b"OK", 42, b"hello", None]
+    client.close()
+    server.close()
+    await server.wait_closed()
+    with pytest.raises(ValueError):
+        RESPClient("http://localhost")
+
+
+def test_unknown_limiter():
+    """Test that unknown limiter modes are rejected."""
+    with pytest.raises(ValueError):
+        make_limiter("leaky", 5, datetime.timedelta(seconds=1))
@@ -0,0 +1,44 @@
+"""Test metrics."""
+import datetime
+
+from trapi_throttle.limiter import make_limiter
+from trapi_throttle.metrics import Histogram, KPMetrics, render
+from trapi_throttle.request_queue import ShapeQueue
+
+
+class FakeServer():
+    """What render needs of a ThrottledServer."""
+
+    def __init__(self):
+        self.request_queue = ShapeQueue()
+        self.limiter = make_limiter("gcra", 2, datetime.timedelta(seconds=1))
+        self.metrics = KPMetrics()
+
+
+def test_histogram():
+    """Test that histogram buckets are cumulative."""
+    histogram = Histogram((1, 5))
+    for value in (0.5, 1, 3, 10):
+        histogram.observe(value)
+    assert histogram.cumulative() == [("1", 2), ("5", 3), ("+Inf", 4)]
+    assert histogram.sum == 14.5
+    assert histogram.count == 4
+
+
+def test_render():
+    """Test rendering metrics in the Prometheus text format."""
+    server = FakeServer()
+    server.request_queue.put_nowait((0, 0), "shape", None)
+    server.metrics.rate_limited.inc()
+    server.metrics.kp_latency.observe(0.2)
+
+    text = render({'kp"1': server})
+    lines = text.splitlines()
+    assert "# TYPE trapi_throttle_queue_depth gauge" in lines
+    assert 'trapi_throttle_queue_depth{kp="kp\\"1"} 1' in lines
+    assert 'trapi_throttle_effective_rate{kp="kp\\"1"} 2.0' in lines
+    assert 'trapi_throttle_rate_limited_total{kp="kp\\"1"} 1' in lines
+    assert 'trapi_throttle_kp_latency_seconds_bucket{kp="kp\\"1",le="0.1"} 0' in lines
+    assert 'trapi_throttle_kp_latency_seconds_bucket{kp="kp\\"1",le="0.25"} 1' in lines
+    assert 'trapi_throttle_kp_latency_seconds_count{kp="kp\\"1"} 1' in lines
+    assert text.endswith("\n")
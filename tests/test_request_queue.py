@@ -0,0 +1,110 @@
+"""Test shape-partitioned request queue."""
+import asyncio
+
+import pytest
+
+from trapi_throttle.request_queue import ShapeQueue
+
+
+def test_highest_priority_shape():
+    """Test that we take the bucket of the highest-priority request."""
+    queue = ShapeQueue()
+    queue.put_nowait((1, 0), "a", "a0")
+    queue.put_nowait((0, 1), "b", "b0")
+    queue.put_nowait((2, 2), "a", "a1")
+    queue.put_nowait((3, 3), "b", "b1")
+
+    shape, batch = queue.get_batch_nowait()
+    assert shape == "b"
+    assert [item for _, item in batch] == ["b0", "b1"]
+    assert queue.qsize() == 2
+
+    shape, batch = queue.get_batch_nowait()
+    assert shape == "a"
+    assert [item for _, item in batch] == ["a0", "a1"]
+    assert queue.empty()
+
+
+def test_max_size():
+    """Test that items beyond the max batch size stay queued."""
+    queue = ShapeQueue()
+    for index in range(5):
+        queue.put_nowait((0, index), "a", index)
+    queue.put_nowait((0, 5), "b", 5)
+
+    shape, batch = queue.get_batch_nowait(max_size=2)
+    assert shape == "a"
+    assert [item for _, item in batch] == [0, 1]
+
+    # "a" still has the highest-priority remaining item
+    shape, batch = queue.get_batch_nowait(max_size=2)
+    assert [item for _, item in batch] == [2, 3]
+
+    shape, batch = queue.get_batch_nowait()
+    assert [item for _, item in batch] == [4]
+    shape, batch = queue.get_batch_nowait()
+    assert shape == "b"
+
+    with pytest.raises(asyncio.QueueEmpty):
+        queue.get_batch_nowait()
+
+
+@pytest.mark.asyncio
+async def test_wait_for_item():
+    """Test that get_batch waits for an item to show up."""
+    queue = ShapeQueue()
+    task = asyncio.create_task(queue.get_batch())
+    await asyncio.sleep(0.01)
+    assert not task.done()
+
+    queue.put_nowait((0, 0), "a", "a0")
+    shape, batch = await asyncio.wait_for(task, timeout=1)
+    assert shape == "a"
+    assert [item for _, item in batch] == ["a0"]
+
+
+def test_admit():
+    """Test that the batch ends at the first item that is not admitted."""
+    queue = ShapeQueue()
+    for index, size in enumerate([1, 2, 100, 3, 200]):
+        queue.put_nowait((0, index), "a", size)
+
+    def admit(size):
+        return size < 10
+
+    _, batch = queue.get_batch_nowait(admit=admit)
+    assert [size for _, size in batch] == [1, 2]
+
+    # the first item is always taken
+    _, batch = queue.get_batch_nowait(admit=admit)
+    assert [size for _, size in batch] == [100, 3]
+
+    _, batch = queue.get_batch_nowait(admit=admit)
+    assert [size for _, size in batch] == [200]
+    assert queue.empty()
+
+
+def test_revise():
+    """Test re-prioritizing and removing a shape's items."""
+    queue = ShapeQueue()
+    for index in range(4):
+        queue.put_nowait((0, index), "a", index)
+    queue.put_nowait((1, 4), "b", 4)
+
+    def revise(priority, item):
+        if item == 0:
+            return None
+        # move odd items behind "b"
+        return (2, priority[1]) if item % 2 else priority
+
+    assert queue.revise("a", revise) == [0]
+    assert queue.qsize() == 4
+
+    shape, batch = queue.get_batch_nowait(max_size=1)
+    assert (shape, [item for _, item in batch]) == ("a", [2])
+    shape, batch = queue.get_batch_nowait()
+    assert (shape, [item for _, item in batch]) == ("b", [4])
+    shape, batch = queue.get_batch_nowait()
+    assert (shape, [item for _, item in batch]) == ("a", [1, 3])
+    assert queue.empty()
+    assert queue.revise("a", revise) == []
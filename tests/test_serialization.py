@@ -0,0 +1,114 @@
+"""Test JSON serialization."""
+import json
+import tracemalloc
+
+import pytest
+
+from trapi_throttle.serialization import (
+    FragmentMemo,
+    TRAPIResponse,
+    loads,
+    stream_response,
+)
+from trapi_throttle.trapi import InvalidMessage, index_results
+
+RESPONSE = {
+    "message": {
+        "query_graph": {"nodes": {}, "edges": {}},
+        "knowledge_graph": {
+            "nodes": {"CHEBI:6801": {"name": "metformin"}},
+            "edges": {},
+        },
+        "results": [
+            {
+                "node_bindings": {"n0": [{"id": "CHEBI:6801"}]},
+                "edge_bindings": {},
+                "score": 0.5,
+            },
+            {
+                "node_bindings": {"n0": [{"id": "CHEBI:6802"}]},
+                "edge_bindings": {},
+            },
+        ],
+    },
+}
+
+
+async def chunked(data: bytes, size: int):
+    """Yield data in chunks, with an empty one in between."""
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+        yield b""
+
+
+def test_loads():
+    """Test that loads decodes bytes and raises JSONDecodeError."""
+    assert loads(json.dumps(RESPONSE).encode()) == RESPONSE
+    with pytest.raises(json.JSONDecodeError):
+        loads(b'{"message": ')
+
+
+@pytest.mark.asyncio
+async def test_stream_response():
+    """Test that streamed responses are decoded and indexed."""
+    pytest.importorskip("ijson")
+    data = json.dumps(RESPONSE).encode()
+    for size in (7, 1000):
+        response, index = await stream_response(chunked(data, size))
+        assert response == RESPONSE
+        assert index == index_results(RESPONSE["message"]["results"])
+
+    with pytest.raises(json.JSONDecodeError):
+        await stream_response(chunked(data[:-10], 7))
+
+    invalid = json.dumps({"message": {"results": [{"node_bindings": []}]}}).encode()
+    with pytest.raises(InvalidMessage):
+        await stream_response(chunked(invalid, 7))
+
+
+@pytest.mark.asyncio
+async def test_stream_response_memory():
+    """Test that the raw body is not held in memory while streaming."""
+    pytest.importorskip("ijson")
+    n = 20000
+    data = json.dumps({"message": {
+        "query_graph": {"nodes": {}, "edges": {}},
+        "knowledge_graph": {
+            "nodes": {f"MONDO:{i}": {"name": "x" * 200} for i in range(n)},
+            "edges": {},
+        },
+        "results": [
+            {"node_bindings": {"n0": [{"id": f"MONDO:{i}"}]}, "edge_bindings": {}}
+            for i in range(n)
+        ],
+    }}).encode()
+
+    async def chunks():
+        for start in range(0, len(data), 65536):
+            yield data[start:start + 65536]
+
+    tracemalloc.start()
+    try:
+        response, index = await stream_response(chunks())
+        kept, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert len(response["message"]["results"]) == n
+    # beyond the decoded response, much less than the body was used
+    assert peak - kept < len(data) / 2
+
+
+def test_encode_fragments():
+    """Test that responses sharing a memo encode shared objects once."""
+    memo = FragmentMemo()
+    message = RESPONSE["message"]
+    responses = [
+        TRAPIResponse(RESPONSE, memo),
+        TRAPIResponse({"message": {**message, "results": message["results"][:1]}}, memo),
+        TRAPIResponse({"message": {**message, "knowledge_graph": None}, "logs": []}, memo),
+    ]
+    for response in responses:
+        assert json.loads(response.encode()) == response
+        assert json.loads(response.encode_fragments()) == response
+    # one node and two results
+    assert len(memo.fragments) == 3
@@ -324,6 +324,34 @@ async def test_duplicate(client):
     assert response.status_code == 200
 
 
+@pytest.mark.asyncio
+async def test_register_nulls(client):
+    """Test that settings that cannot be null are rejected as null."""
+    kp_info = {
+        "url": "http://kp1/query",
+        "request_qty": 1,
+        "request_duration": 1,
+    }
+    for field in (
+        "max_in_flight",
+        "linger",
+        "validation",
+        "streaming",
+        "cache_size",
+        "cache_ttl",
+        "limiter_lease",
+    ):
+        response = await client.post("/register/kp1", json={**kp_info, field: None})
+        assert response.status_code == 422, field
+    assert "kp1" not in APP.throttle.servers
+
+    # limits can be null
+    response = await client.post("/register/kp1", json={**kp_info, "max_batch_size": None})
+    assert response.status_code == 200
+    response = await client.get("/unregister/kp1")
+    assert response.status_code == 200
+
+
 @with_kp_overlay(
     "http://kp1/query",
     kp_data="""
@@ -0,0 +1,44 @@
+"""Test latency breakdowns."""
+from trapi_throttle.timing import BatchTiming, breakdown, server_timing
+
+
+def batch_timing(**timestamps) -> BatchTiming:
+    timing = BatchTiming(0)
+    for stage, timestamp in timestamps.items():
+        setattr(timing, stage, timestamp)
+    return timing
+
+
+def test_breakdown():
+    """Test splitting a request's time into stages."""
+    timing = batch_timing(
+        linger_start=1.0,
+        rate_limit_start=1.1,
+        rate_limit_end=1.6,
+        sent=1.7,
+        received=2.7,
+        split=2.8,
+    )
+    durations = breakdown(0.5, timing)
+    assert list(durations) == ["queue", "linger", "rate_limit", "merge", "kp", "split", "total"]
+    assert round(durations["queue"], 6) == 0.5
+    assert round(durations["kp"], 6) == 1.0
+    assert round(durations["total"], 6) == 2.3
+
+    # a request that arrived while the batch lingered
+    durations = breakdown(1.05, timing)
+    assert durations["queue"] == 0
+    assert round(durations["linger"], 6) == 0.05
+    assert round(durations["total"], 6) == 1.75
+
+
+def test_breakdown_cached():
+    """Test that stages that did not happen are left out."""
+    timing = batch_timing(linger_start=1.0, rate_limit_start=1.0, rate_limit_end=1.0, split=1.1)
+    assert "kp" not in breakdown(1.0, timing)
+    assert breakdown(1.0, None) == {}
+
+
+def test_server_timing():
+    """Test formatting a Server-Timing header."""
+    assert server_timing({"kp": 0.25, "total": 0.5}) == "kp;dur=250.0, total;dur=500.0"
@@ -0,0 +1,227 @@
+"""Test TRAPI batching utilities."""
+import pytest
+
+from trapi_throttle.trapi import (
+    BatchingError,
+    InvalidMessage,
+    check_query,
+    check_response,
+    filter_by_curie_mapping,
+    fingerprint,
+    index_results,
+    merge_parts,
+    rename_bindings,
+)
+
+
+def one_hop(
+        subject="n0",
+        object="n1",
+        edge="n0n1",
+        curies=("CHEBI:6801",),
+        predicates=("biolink:treats",),
+        categories=("biolink:Disease",),
+):
+    """Build a one-hop query graph."""
+    return {
+        "nodes": {
+            subject: {"ids": list(curies)},
+            object: {"categories": list(categories)},
+        },
+        "edges": {
+            edge: {
+                "subject": subject,
+                "object": object,
+                "predicates": list(predicates),
+            },
+        },
+    }
+
+
+def test_fingerprint_ignores_curies():
+    """Test that query graphs differing only in curies match."""
+    key_a, *_ = fingerprint(one_hop(curies=["CHEBI:6801"]))
+    key_b, *_ = fingerprint(one_hop(curies=["CHEBI:6802", "CHEBI:6803"]))
+    assert key_a == key_b
+
+
+def test_fingerprint_normalizes():
+    """Test that naming and list order do not change the fingerprint."""
+    qgraph_a = one_hop(
+        predicates=["biolink:treats", "biolink:affects"],
+        categories=["biolink:Disease", "biolink:PhenotypicFeature"],
+    )
+    qgraph_b = one_hop(
+        subject="b",
+        object="a",
+        edge="ba",
+        predicates=["biolink:affects", "biolink:treats"],
+        categories=["biolink:PhenotypicFeature", "biolink:Disease"],
+    )
+    key_a, node_map_a, edge_map_a = fingerprint(qgraph_a)
+    key_b, node_map_b, edge_map_b = fingerprint(qgraph_b)
+    assert key_a == key_b
+    assert node_map_a["n0"] == node_map_b["b"]
+    assert node_map_a["n1"] == node_map_b["a"]
+    assert edge_map_a["n0n1"] == edge_map_b["ba"]
+
+
+def test_fingerprint_differs():
+    """Test that structurally different query graphs do not match."""
+    key, *_ = fingerprint(one_hop())
+    assert key != fingerprint(one_hop(predicates=["biolink:affects"]))[0]
+    assert key != fingerprint(one_hop(categories=["biolink:Gene"]))[0]
+
+    # pinned and unpinned nodes are different
+    unpinned = one_hop()
+    del unpinned["nodes"]["n0"]["ids"]
+    assert key != fingerprint(unpinned)[0]
+
+    # edge direction matters
+    reversed_edge = one_hop()
+    reversed_edge["edges"]["n0n1"]["subject"] = "n1"
+    reversed_edge["edges"]["n0n1"]["object"] = "n0"
+    assert key != fingerprint(reversed_edge)[0]
+
+
+def test_rename_bindings():
+    """Test renaming result bindings."""
+    results = [{
+        "node_bindings": {"n0": [{"id": "CHEBI:6801"}]},
+        "edge_bindings": {"n0n1": [{"id": "e0"}]},
+        "score": 1.0,
+    }]
+    renamed = rename_bindings(results, {"n0": "a"}, {"n0n1": "ab"})
+    assert renamed == [{
+        "node_bindings": {"a": [{"id": "CHEBI:6801"}]},
+        "edge_bindings": {"ab": [{"id": "e0"}]},
+        "score": 1.0,
+    }]
+    # the original results are left alone
+    assert "n0" in results[0]["node_bindings"]
+
+
+def test_merge_parts():
+    """Test that results found through several curies are kept once."""
+    result = {
+        "node_bindings": {
+            "n0": [{"id": "CHEBI:6801"}, {"id": "CHEBI:6802"}],
+            "n1": [{"id": "MONDO:0005148"}],
+        },
+        "edge_bindings": {"n0n1": [{"id": "e0"}, {"id": "e1"}]},
+    }
+    parts = [
+        ({"nodes": {curie: {}}, "edges": {}}, rename_bindings([result], {"n0": "a"}, {}))
+        for curie in ("CHEBI:6801", "CHEBI:6802")
+    ]
+    kgraph, results = merge_parts(parts)
+    assert set(kgraph["nodes"]) == {"CHEBI:6801", "CHEBI:6802"}
+    assert len(results) == 1
+
+
+def test_filter_with_index():
+    """Test that splitting with an index matches scanning the results."""
+    message = {
+        "knowledge_graph": {
+            "nodes": {
+                "CHEBI:6801": {}, "CHEBI:6802": {}, "MONDO:0005148": {},
+            },
+            "edges": {"e0": {}, "e1": {}},
+        },
+        "results": [
+            {
+                "node_bindings": {
+                    "n0": [{"id": "CHEBI:6801"}],
+                    "n1": [{"id": "MONDO:0005148"}],
+                },
+                "edge_bindings": {"n0n1": [{"id": "e0"}]},
+            },
+            {
+                "node_bindings": {
+                    "n0": [{"id": "CHEBI:6802"}],
+                    "n1": [{"id": "MONDO:0005148"}],
+                },
+                "edge_bindings": {"n0n1": [{"id": "e1"}]},
+            },
+        ],
+    }
+    index = index_results(message["results"])
+    for curie_mapping in (
+        {"n0": ["CHEBI:6801"]},
+        {"n0": ["CHEBI:6801", "CHEBI:6802"]},
+        {"n0": ["CHEBI:6802"], "n1": ["MONDO:0005148"]},
+        {"n0": ["CHEBI:6801"], "n1": ["MONDO:0005149"]},
+        {},
+    ):
+        assert (
+            filter_by_curie_mapping(message, curie_mapping, index=index)
+            == filter_by_curie_mapping(message, curie_mapping)
+        )
+
+    kgraph, results = filter_by_curie_mapping(
+        message, {"n0": ["CHEBI:6802"]}, index=index,
+    )
+    assert results == [message["results"][1]]
+    assert set(kgraph["nodes"]) == {"CHEBI:6802", "MONDO:0005148"}
+    assert set(kgraph["edges"]) == {"e1"}
+
+
+def test_filter_dangling_binding():
+    """Test that bindings to missing knowledge graph nodes are reported."""
+    message = {
+        "knowledge_graph": {"nodes": {}, "edges": {}},
+        "results": [{
+            "node_bindings": {"n0": [{"id": "CHEBI:6801"}]},
+            "edge_bindings": {},
+        }],
+    }
+    with pytest.raises(BatchingError):
+        filter_by_curie_mapping(message, {"n0": ["CHEBI:6801"]})
+
+
+def test_check_response():
+    """Test the structural check of KP responses."""
+    result = {
+        "node_bindings": {"n0": [{"id": "CHEBI:6801"}]},
+        "edge_bindings": {"n0n1": []},
+    }
+    kgraph = {"nodes": {}, "edges": {}}
+    for message in (
+        {},
+        {"knowledge_graph": None, "results": None},
+        {"knowledge_graph": kgraph, "results": []},
+        {"knowledge_graph": kgraph, "results": [result]},
+    ):
+        check_response({"message": message})
+
+    for response in (
+        {},
+        {"message": None},
+        {"message": {"knowledge_graph": {"nodes": {}}}},
+        {"message": {"knowledge_graph": kgraph, "results": {}}},
+        {"message": {"results": [result]}},
+        {"message": {"knowledge_graph": kgraph, "results": [{"node_bindings": {}}]}},
+        {"message": {"knowledge_graph": kgraph, "results": [{
+            **result,
+            "node_bindings": {"n0": [{"kg_id": "CHEBI:6801"}]},
+        }]}},
+    ):
+        with pytest.raises(InvalidMessage):
+            check_response(response)
+
+
+def test_check_query():
+    """Test the structural check of queries."""
+    check_query({"message": {"query_graph": one_hop()}})
+    check_query({"message": {"query_graph": {"nodes": {"n0": {"ids": None}}, "edges": {}}}})
+
+    for query in (
+        [],
+        {"message": {}},
+        {"message": {"query_graph": {"nodes": {}}}},
+        {"message": {"query_graph": {"nodes": {"n0": []}, "edges": {}}}},
+        {"message": {"query_graph": {"nodes": {"n0": {"ids": "CHEBI:6801"}}, "edges": {}}}},
+        {"message": {"query_graph": {"nodes": {}, "edges": {"e0": {"subject": "n0"}}}}},
+    ):
+        with pytest.raises(InvalidMessage):
+            check_query(query)
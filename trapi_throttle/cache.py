@@ -0,0 +1,56 @@
+"""Result cache."""
+from collections import OrderedDict
+from collections.abc import Hashable
+import time
+from typing import Any, Optional
+
+
+class ResultCache():
+    """
+    Least-recently-used cache with a time-to-live.
+
+    Holds at most maxsize entries, each for at most ttl seconds,
+    and counts hits and misses.
+    """
+
+    def __init__(
+            self,
+            maxsize: int,
+            ttl: float,
+    ):
+        """Initialize."""
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        """Check for a live entry, without counting a hit or miss."""
+        entry = self.entries.get(key)
+        return entry is not None and entry[0] > time.monotonic()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Get a live entry, or None."""
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires, value = entry
+        if expires <= time.monotonic():
+            del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: Hashable, value: Any):
+        """Add an entry, evicting the least recently used if full."""
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
@@ -0,0 +1,86 @@
+"""Capture of incoming queries, for replaying them later."""
+import asyncio
+import logging
+import time
+from typing import Optional
+
+from .serialization import dumps, loads
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Capture():
+    """
+    Append queries to a JSON lines file.
+
+    Each line holds the arrival time (seconds since the epoch),
+    the KP id and the query.
+
+    Records are buffered and written every flush_interval seconds by
+    a background task, through the default executor, so that the event
+    loop never waits for the disk. Close the capture to write the rest.
+    """
+
+    def __init__(self, path: str, flush_interval: float = 1.0):
+        """Initialize."""
+        self.stream = open(path, "ab")
+        self.flush_interval = flush_interval
+        self.buffer: list[bytes] = []
+        self.closing = asyncio.Event()
+        self.writer: Optional[asyncio.Task] = None
+
+    def record(self, kp_id: str, query: dict):
+        """Record a query as it arrives."""
+        self.buffer.append(dumps({
+            "time": time.time(),
+            "kp_id": kp_id,
+            "query": query,
+        }) + b"\n")
+        if self.writer is None:
+            self.writer = asyncio.create_task(self.run())
+
+    async def run(self):
+        """Write buffered records until the capture is closed."""
+        while not self.closing.is_set():
+            try:
+                await asyncio.wait_for(self.closing.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush()
+            except OSError as err:
+                LOGGER.warning(f"Unable to write captured queries: {err!r}")
+
+    async def flush(self):
+        """Write the buffered records."""
+        if not self.buffer:
+            return
+        data = b"".join(self.buffer)
+        self.buffer = []
+        await asyncio.get_running_loop().run_in_executor(None, self.write, data)
+
+    def write(self, data: bytes):
+        """Write to the file (blocking)."""
+        self.stream.write(data)
+        self.stream.flush()
+
+    async def close(self):
+        """Write the buffered records and close the file."""
+        self.closing.set()
+        if self.writer is not None:
+            await self.writer
+        await self.flush()
+        self.stream.close()
+
+
+def read_capture(path: str) -> list[tuple[float, str, dict]]:
+    """Read captured (time, KP id, query) records in arrival order."""
+    records = []
+    with open(path, "rb") as stream:
+        for line in stream:
+            if not line.strip():
+                continue
+            record = loads(line)
+            records.append((record["time"], record["kp_id"], record["query"]))
+    records.sort(key=lambda record: record[0])
+    return records
@@ -1,8 +1,31 @@
+from typing import Optional
+
 from pydantic import \
     BaseSettings
 
 
 class Settings(BaseSettings):
+    # Default connection pool for each registered KP
+    max_connections: Optional[int] = None
+    max_keepalive_connections: Optional[int] = None
+    keepalive_expiry: Optional[float] = 5.0
+    http2: bool = False
+    # Take /{kp_id}/query bodies as they are, with only a structural check
+    raw_ingress: bool = False
+    # Report per-request latency breakdowns in a Server-Timing header
+    server_timing: bool = False
+    # Export batches and requests as OpenTelemetry spans
+    tracing: bool = False
+    # Share each KP's rate limit with other processes through files in this directory
+    limiter_dir: Optional[str] = None
+    # Share each KP's rate limit with other replicas through this redis:// server
+    limiter_url: Optional[str] = None
+    # Seconds to wait for the limiter_url server before limiting locally
+    limiter_timeout: float = 1.0
+    # Append /{kp_id}/query arrivals to this JSON lines file, for replaying
+    capture_file: Optional[str] = None
+    # Seconds between checks for /{kp_id}/query clients that left, 0 to not check
+    disconnect_poll_interval: float = 0.5
 
     class Config:
         env_file = ".env"
@@ -0,0 +1,550 @@
+"""Rate limiters."""
+import asyncio
+from collections import deque
+import datetime
+import logging
+import os
+import struct
+import time
+from typing import Optional
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+from .resp import RedisError, RESPClient
+
+LOGGER = logging.getLogger(__name__)
+
+
+class AdaptiveRate():
+    """
+    Request rate that adapts to a KP's 429s (AIMD).
+
+    This is the base of every rate limiter, which ThrottledServer uses
+    through next_slot() to see when a request could go out, acquire()
+    before each request, refund() when nothing was sent after all, penalize() after a 429, recover() after a successful
+    response, stats() and close().
+
+    The rate starts at request_qty per request_duration. A 429 cuts it
+    by the decrease factor, at most once per request_duration so that the
+    429s of requests sent together count once, and each successful
+    response adds increase requests per request_duration, up to the
+    configured rate. It never drops below one request per request_duration.
+
+    A request_qty of 0 disables the rate limit; 429s are then only
+    honored through their Retry-After.
+    """
+
+    def __init__(
+            self,
+            request_qty: int,
+            request_duration: datetime.timedelta,
+            decrease: float = 0.5,
+            increase: float = 1.0,
+    ):
+        """Initialize."""
+        seconds = request_duration.total_seconds()
+        if request_qty > 0 and seconds > 0:
+            self.max_rate = request_qty / seconds
+            self.min_rate = min(1 / seconds, self.max_rate)
+        else:
+            self.max_rate = self.min_rate = 0.0
+        self.rate = self.max_rate
+        self.decrease = decrease
+        self.increase = increase / seconds if seconds > 0 else 0.0
+        self.window = seconds
+        self.penalties = 0
+        self.slowed_at = float("-inf")
+
+    def set_rate(self, rate: float):
+        """Change the rate."""
+        self.rate = rate
+
+    def slow_down(self):
+        """Cut the rate (e.g. after a 429) unless it was cut within the window."""
+        self.penalties += 1
+        now = time.monotonic()
+        if self.max_rate and now - self.slowed_at >= self.window:
+            self.slowed_at = now
+            self.set_rate(max(self.min_rate, self.rate * self.decrease))
+
+    def recover(self):
+        """Raise the rate towards the configured one (e.g. after a response)."""
+        if self.rate < self.max_rate:
+            self.set_rate(min(self.max_rate, self.rate + self.increase))
+
+    def next_slot(self) -> float:
+        """
+        Return when (in time.monotonic() seconds) acquire() would let
+        a request through, without accounting for one.
+        """
+        raise NotImplementedError
+
+    async def acquire(self):
+        """Wait until a request may be sent and account for it."""
+        raise NotImplementedError
+
+    def refund(self):
+        """Give back what the last acquire() accounted for."""
+        raise NotImplementedError
+
+    def penalize(self, retry_after: Optional[float] = None):
+        """Slow down after a 429, holding off for retry_after seconds if given."""
+        raise NotImplementedError
+
+    def stats(self) -> dict[str, float]:
+        """
+        Report the learned and configured rates, in requests
+        per second, and the number of 429s seen.
+        """
+        return {
+            "rate": self.rate,
+            "max_rate": self.max_rate,
+            "penalties": self.penalties,
+        }
+
+    def close(self):
+        """Release any resources held by the limiter."""
+
+
+class GCRALimiter(AdaptiveRate):
+    """
+    Rate limiter implementing the generic cell rate algorithm (GCRA).
+
+    The limiter keeps track of the TAT (Theoretical Arrival Time),
+    when the next request should be sent to adhere to the rate limit.
+    More information can be found here:
+    https://dev.to/astagi/rate-limiting-using-python-and-redis-58gk
+
+    With the default burst of 1, requests are spaced exactly one interval
+    apart. A larger burst adds tolerance so that up to burst requests can
+    go out back to back after an idle period.
+
+    A request_qty of 0 disables the rate limit.
+    """
+
+    def __init__(
+            self,
+            request_qty: int,
+            request_duration: datetime.timedelta,
+            burst: int = 1,
+            **kwargs,
+    ):
+        """Initialize."""
+        super().__init__(request_qty, request_duration, **kwargs)
+        self.burst = max(burst, 1)
+        self.tat = float("-inf")
+
+    @property
+    def interval(self) -> float:
+        return 1 / self.rate if self.rate else 0.0
+
+    @property
+    def tolerance(self) -> float:
+        return (self.burst - 1) * self.interval
+
+    def next_slot(self) -> float:
+        """Return when acquire() would let a request through."""
+        return max(self.tat - self.tolerance, time.monotonic())
+
+    async def acquire(self):
+        """Wait until a request may be sent and account for it."""
+        now = time.monotonic()
+        tat = max(self.tat, now)
+        allowed_at = tat - self.tolerance
+        # Reserve the slot before sleeping so that
+        # concurrent callers queue up behind it
+        self.tat = tat + self.interval
+        if allowed_at > now:
+            await asyncio.sleep(allowed_at - now)
+
+    def refund(self):
+        """Give back the slot of the last acquire()."""
+        self.tat -= self.interval
+
+    def penalize(self, retry_after: Optional[float] = None):
+        """
+        Slow down after a 429 and hold off the next request
+        for retry_after seconds, or one interval.
+        """
+        self.slow_down()
+        hold = self.interval if retry_after is None else retry_after
+        self.tat = max(self.tat, time.monotonic() + hold + self.tolerance)
+
+
+class SharedGCRALimiter(GCRALimiter):
+    """
+    GCRA limiter whose TAT is shared, through a file, with every
+    limiter using the same file, e.g. in the other worker processes
+    of a server on the same host.
+
+    The file holds the TAT as wall-clock time (seconds since the epoch),
+    so that it stays meaningful after a reboot and between hosts sharing
+    the directory, and is locked with flock while it is read and updated.
+    A stored TAT is never trusted to be more than burst intervals plus
+    request_duration, or max_hold if longer, ahead of now, so that a clock
+    jump cannot hold off requests indefinitely. The learned rate is still
+    kept per process. Requires fcntl (not available on Windows).
+    """
+
+    STATE = struct.Struct("d")
+
+    def __init__(
+            self,
+            path: str,
+            request_qty: int,
+            request_duration: datetime.timedelta,
+            burst: int = 1,
+            max_hold: float = 0.0,
+            **kwargs,
+    ):
+        """Initialize."""
+        super().__init__(request_qty, request_duration, burst, **kwargs)
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        # how far ahead of now the TAT can rightly be, besides the burst:
+        # other processes' requests queued within a request_duration, or
+        # a hold after a 429
+        self.horizon = max(request_duration.total_seconds(), max_hold)
+
+    def read_tat(self, now: float, offset: float) -> float:
+        """
+        Read the shared TAT as a time.monotonic() timestamp, given
+        the offset of wall-clock time. The file must be locked.
+        """
+        data = os.pread(self.fd, self.STATE.size, 0)
+        if len(data) != self.STATE.size:
+            return float("-inf")
+        tat = self.STATE.unpack(data)[0] - offset
+        return min(tat, now + self.burst * self.interval + self.horizon)
+
+    def update_tat(self, update) -> float:
+        """
+        Replace the shared TAT with update(TAT), holding the file lock,
+        and return the old TAT, as time.monotonic() timestamps.
+        """
+        now = time.monotonic()
+        offset = time.time() - now
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            tat = self.read_tat(now, offset)
+            os.pwrite(self.fd, self.STATE.pack(update(tat) + offset), 0)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        return tat
+
+    def next_slot(self) -> float:
+        """Return when acquire() would let a request of this process through."""
+        now = time.monotonic()
+        offset = time.time() - now
+        fcntl.flock(self.fd, fcntl.LOCK_SH)
+        try:
+            tat = self.read_tat(now, offset)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        return max(tat - self.tolerance, now)
+
+    async def acquire(self):
+        """Wait until a request may be sent and account for it."""
+        now = time.monotonic()
+        tat = max(self.update_tat(lambda tat: max(tat, now) + self.interval), now)
+        self.tat = tat + self.interval
+        allowed_at = tat - self.tolerance
+        if allowed_at > now:
+            await asyncio.sleep(allowed_at - now)
+
+    def refund(self):
+        """Give back the slot of the last acquire() to every process."""
+        self.update_tat(lambda tat: tat - self.interval)
+        self.tat -= self.interval
+
+    def penalize(self, retry_after: Optional[float] = None):
+        """
+        Slow down after a 429 and hold off the next request of every
+        process for retry_after seconds, or one interval.
+        """
+        self.slow_down()
+        hold = self.interval if retry_after is None else retry_after
+        held = time.monotonic() + hold + self.tolerance
+        self.tat = max(self.update_tat(lambda tat: max(tat, held)), held)
+
+    def close(self):
+        """Close the state file."""
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+# Reserve ARGV[3] consecutive GCRA slots of ARGV[1] microseconds, after
+# holding off for ARGV[4] microseconds if it is not negative, with a
+# tolerance of ARGV[2] microseconds. Returns how long to wait for the
+# first slot, in microseconds. Times come from the server's clock so
+# that every client shares it.
+GCRA_SCRIPT = """
+local time = redis.call("TIME")
+local now = tonumber(time[1]) * 1000000 + tonumber(time[2])
+local interval = tonumber(ARGV[1])
+local tolerance = tonumber(ARGV[2])
+local count = tonumber(ARGV[3])
+local hold = tonumber(ARGV[4])
+local tat = math.max(tonumber(redis.call("GET", KEYS[1])) or now, now)
+if hold >= 0 then
+    tat = math.max(tat, now + hold + tolerance)
+end
+local new_tat = tat + count * interval
+redis.call("SET", KEYS[1], string.format("%d", new_tat),
+    "PX", math.floor((new_tat - now) / 1000) + 1000)
+return math.floor(tat - tolerance - now)
+"""
+
+
+class RedisGCRALimiter(GCRALimiter):
+    """
+    GCRA limiter whose TAT is kept in a Redis-protocol server, so that
+    every replica of the throttle shares the KP's rate limit.
+
+    Slots are reserved atomically with GCRA_SCRIPT. To save a round
+    trip per request, lease slots are reserved at a time and handed out
+    locally; slots that pass unused are dropped, so a lease larger than
+    1 trades some of the budget for fewer round trips. A 429 is passed
+    on to the server with the next reservation. The learned rate is
+    kept per replica.
+
+    If the server cannot be reached, or does not answer within timeout
+    seconds, the limiter falls back to limiting this replica alone.
+    """
+
+    def __init__(
+            self,
+            url: str,
+            key: str,
+            request_qty: int,
+            request_duration: datetime.timedelta,
+            burst: int = 1,
+            lease: int = 1,
+            timeout: float = 1.0,
+            **kwargs,
+    ):
+        """Initialize."""
+        super().__init__(request_qty, request_duration, burst, **kwargs)
+        self.client = RESPClient(url, timeout)
+        self.key = key
+        self.lease = max(lease, 1)
+        self.slots: deque[float] = deque()
+        self.hold: Optional[float] = None
+        self.lease_lock = asyncio.Lock()
+
+    async def reserve(self, now: float):
+        """Reserve a lease of slots from the server."""
+        hold = self.hold
+        wait = await self.client.execute(
+            "EVAL", GCRA_SCRIPT, 1, self.key,
+            round(self.interval * 1e6),
+            round(self.tolerance * 1e6),
+            self.lease,
+            -1 if hold is None else round(hold * 1e6),
+        )
+        if self.hold == hold:
+            self.hold = None
+        first = now + max(wait, 0) / 1e6
+        self.slots.extend(first + index * self.interval for index in range(self.lease))
+
+    def next_slot(self) -> float:
+        """
+        Return when acquire() would let a request through: the next
+        leased slot or, without a round trip to the server, this
+        replica's own estimate.
+        """
+        now = time.monotonic()
+        for slot in self.slots:
+            if slot >= now - self.interval:
+                return max(slot, now)
+        return max(self.tat - self.tolerance, now)
+
+    async def acquire(self):
+        """Wait until a request may be sent and account for it."""
+        async with self.lease_lock:
+            now = time.monotonic()
+            while self.slots and self.slots[0] < now - self.interval:
+                self.slots.popleft()
+            if not self.slots:
+                try:
+                    await self.reserve(now)
+                except (
+                    OSError,
+                    asyncio.IncompleteReadError,
+                    asyncio.TimeoutError,
+                    RedisError,
+                ) as err:
+                    LOGGER.warning(
+                        f"Rate limit server unavailable ({err!r}), limiting {self.key} locally"
+                    )
+                    self.slots.append(max(self.tat, now) - self.tolerance)
+            slot = self.slots.popleft()
+            self.tat = max(self.tat, slot + self.tolerance) + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def refund(self):
+        """
+        Give back the slot of the last acquire() to this replica's lease;
+        like other leased slots, it is dropped if it passes unused.
+        """
+        self.slots.appendleft(time.monotonic())
+        self.tat -= self.interval
+
+    def penalize(self, retry_after: Optional[float] = None):
+        """
+        Slow down after a 429, drop the leased slots and hold off the
+        next request of every replica for retry_after seconds, or one
+        interval.
+        """
+        super().penalize(retry_after)
+        self.slots.clear()
+        hold = self.interval if retry_after is None else retry_after
+        self.hold = max(self.hold or 0.0, hold)
+
+    def stats(self) -> dict[str, float]:
+        """Report the rates, the number of 429s seen and the leased slots left."""
+        return {**super().stats(), "leased": len(self.slots)}
+
+    def close(self):
+        """Close the connection to the server."""
+        self.client.close()
+
+
+class TokenBucketLimiter(AdaptiveRate):
+    """
+    Token bucket rate limiter.
+
+    The bucket holds up to burst tokens (request_qty by default)
+    and refills at request_qty tokens per request_duration. It starts
+    full, so e.g. "60 per minute" allows 60 requests right away.
+
+    A request_qty of 0 disables the rate limit.
+    """
+
+    def __init__(
+            self,
+            request_qty: int,
+            request_duration: datetime.timedelta,
+            burst: Optional[int] = None,
+            **kwargs,
+    ):
+        """Initialize."""
+        super().__init__(request_qty, request_duration, **kwargs)
+        self.capacity = float(max(burst or request_qty, 1))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.hold_until = float("-inf")
+
+    def set_rate(self, rate: float):
+        """Change the refill rate, keeping the tokens accumulated so far."""
+        self.refill()
+        self.rate = rate
+
+    def refill(self):
+        """Add the tokens accumulated since the last update."""
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity,
+            self.tokens + (now - self.updated) * self.rate,
+        )
+        self.updated = now
+
+    def next_slot(self) -> float:
+        """Return when acquire() would let a request through."""
+        now = time.monotonic()
+        slot = max(self.hold_until, now)
+        if self.rate == 0:
+            return slot
+        tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        return max(slot, now + (1 - tokens) / self.rate)
+
+    async def acquire(self):
+        """Wait until a request may be sent and account for it."""
+        hold = self.hold_until - time.monotonic()
+        if hold > 0:
+            await asyncio.sleep(hold)
+        if self.rate == 0:
+            return
+        self.refill()
+        # Take the token now, going into debt if needed,
+        # so that concurrent callers queue up behind it
+        self.tokens -= 1
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+    def refund(self):
+        """Put back the token of the last acquire()."""
+        if self.rate == 0:
+            return
+        self.refill()
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+    def penalize(self, retry_after: Optional[float] = None):
+        """
+        Slow down and empty the bucket after a 429, holding
+        off requests for retry_after seconds if given.
+        """
+        self.slow_down()
+        self.refill()
+        self.tokens = min(self.tokens, 0.0)
+        if retry_after is not None:
+            self.hold_until = max(self.hold_until, time.monotonic() + retry_after)
+
+
+LIMITERS = {
+    "gcra": GCRALimiter,
+    "token_bucket": TokenBucketLimiter,
+}
+
+
+def make_limiter(
+        mode: str,
+        request_qty: int,
+        request_duration: datetime.timedelta,
+        burst: Optional[int] = None,
+        state_file: Optional[str] = None,
+        state_url: Optional[str] = None,
+        key: str = "trapi_throttle",
+        lease: int = 1,
+        state_timeout: float = 1.0,
+        max_hold: float = 0.0,
+        **kwargs,
+):
+    """
+    Build a rate limiter of the given mode.
+
+    If a state file is given, the limiter's state is shared with
+    every other limiter using that file (see SharedGCRALimiter). If a
+    redis:// state URL is given, it is shared with every other limiter
+    using the same key on that server (see RedisGCRALimiter), leasing
+    lease slots at a time and waiting up to state_timeout seconds for
+    the server. max_hold is the longest a 429 may hold off
+    requests through a state file. Keyword arguments (decrease, increase)
+    set how its rate adapts.
+    """
+    try:
+        limiter_cls = LIMITERS[mode]
+    except KeyError:
+        raise ValueError(
+            f"Unknown rate limiter {mode}, expected one of {', '.join(LIMITERS)}"
+        )
+    if (state_file is not None or state_url is not None) and limiter_cls is not GCRALimiter:
+        raise ValueError("Shared rate limit state requires the gcra rate limiter")
+    if state_url is not None:
+        return RedisGCRALimiter(
+            state_url, key, request_qty, request_duration, burst or 1, lease, state_timeout, **kwargs,
+        )
+    if state_file is not None:
+        if fcntl is None:
+            raise ValueError("Shared rate limit state requires fcntl")
+        return SharedGCRALimiter(
+            state_file, request_qty, request_duration, burst or 1, max_hold, **kwargs,
+        )
+    if burst is None:
+        return limiter_cls(request_qty, request_duration, **kwargs)
+    return limiter_cls(request_qty, request_duration, burst, **kwargs)
@@ -0,0 +1,129 @@
+"""Metrics in the Prometheus text format."""
+from bisect import bisect_left
+from typing import Callable
+
+# Bucket upper bounds
+SECONDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SIZES = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+class Counter():
+    """Monotonically increasing count."""
+
+    __slots__ = ("value",)
+
+    def __init__(self):
+        """Initialize."""
+        self.value = 0
+
+    def inc(self, amount: int = 1):
+        self.value += amount
+
+
+class Histogram():
+    """
+    Counts of observations in cumulative buckets.
+
+    Observations only update numbers; nothing is formatted
+    until the metrics are rendered.
+    """
+
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: tuple[float, ...]):
+        """Initialize."""
+        self.bounds = bounds
+        # one more for +Inf
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> list[tuple[str, int]]:
+        """(le, count) pairs of the cumulative buckets."""
+        pairs = []
+        total = 0
+        for bound, count in zip([*map(str, self.bounds), "+Inf"], self.counts):
+            total += count
+            pairs.append((bound, total))
+        return pairs
+
+
+class KPMetrics():
+    """Metrics of one KP's throttle."""
+
+    def __init__(self):
+        """Initialize."""
+        self.batch_subrequests = Histogram(SIZES)
+        self.batch_curies = Histogram(SIZES)
+        self.rate_limit_wait = Histogram(SECONDS)
+        self.kp_latency = Histogram(SECONDS)
+        self.split_time = Histogram(SECONDS)
+        self.rate_limited = Counter()
+        self.timeouts = Counter()
+        self.requeued = Counter()
+        self.dropped = Counter()
+        self.deferred = Counter()
+        self.abandoned = Counter()
+
+
+PREFIX = "trapi_throttle_"
+
+# name, type, help and how to get the value from a ThrottledServer
+METRICS: list[tuple[str, str, str, Callable]] = [
+    ("queue_depth", "gauge", "Requests waiting to be batched.",
+     lambda server: server.request_queue.qsize()),
+    ("effective_rate", "gauge", "Current rate limit in requests per second, 0 if unlimited.",
+     lambda server: server.limiter.rate),
+    ("batch_subrequests", "histogram", "Sub-requests per batch sent to the KP.",
+     lambda server: server.metrics.batch_subrequests),
+    ("batch_curies", "histogram", "Curies per batch sent to the KP.",
+     lambda server: server.metrics.batch_curies),
+    ("rate_limit_wait_seconds", "histogram", "Time spent waiting for the rate limiter.",
+     lambda server: server.metrics.rate_limit_wait),
+    ("kp_latency_seconds", "histogram", "Time from sending a batch to the KP to receiving its response.",
+     lambda server: server.metrics.kp_latency),
+    ("split_seconds", "histogram", "Time spent splitting KP responses.",
+     lambda server: server.metrics.split_time),
+    ("rate_limited_total", "counter", "429 responses from the KP.",
+     lambda server: server.metrics.rate_limited.value),
+    ("timeouts_total", "counter", "Batches that timed out.",
+     lambda server: server.metrics.timeouts.value),
+    ("requeued_total", "counter", "Requests re-queued after a 429.",
+     lambda server: server.metrics.requeued.value),
+    ("dropped_total", "counter", "Queued requests dropped because their callers gave up.",
+     lambda server: server.metrics.dropped.value),
+    ("deferred_total", "counter", "Queued requests moved back because they could not meet their deadline.",
+     lambda server: server.metrics.deferred.value),
+    ("abandoned_total", "counter", "KP requests cancelled because all of their callers left.",
+     lambda server: server.metrics.abandoned.value),
+]
+
+
+def escape(value: str) -> str:
+    """Escape a label value."""
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def render(servers: dict) -> str:
+    """Render the metrics of ThrottledServers, by KP id, as Prometheus text."""
+    labels = {kp_id: f'kp="{escape(kp_id)}"' for kp_id in servers}
+    lines = []
+    for name, metric_type, help_text, get in METRICS:
+        name = PREFIX + name
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for kp_id, server in servers.items():
+            value = get(server)
+            if metric_type != "histogram":
+                lines.append(f"{name}{{{labels[kp_id]}}} {value}")
+                continue
+            for bound, count in value.cumulative():
+                lines.append(f'{name}_bucket{{{labels[kp_id]},le="{bound}"}} {count}')
+            lines.append(f"{name}_sum{{{labels[kp_id]}}} {value.sum}")
+            lines.append(f"{name}_count{{{labels[kp_id]}}} {value.count}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,165 @@
+"""Request queue partitioned by query-graph shape."""
+import asyncio
+from collections.abc import Hashable
+import heapq
+from typing import Any, Callable, Optional
+
+
+class ShapeQueue():
+    """
+    Priority queue partitioned by query-graph shape.
+
+    Each shape has its own heap of (priority, item) pairs. A second
+    heap holds the head priority of each shape so that the shape
+    with the highest-priority (lowest) request can be found without
+    looking at the other shapes. Entries in the head heap are
+    invalidated lazily: an entry is stale if its priority is no longer
+    the head of its shape's bucket.
+
+    Priorities must be unique, e.g. (priority, counter) tuples.
+    """
+
+    def __init__(self):
+        """Initialize."""
+        self.buckets: dict[Hashable, list[tuple[Any, Any]]] = dict()
+        self.heads: list[tuple[Any, Hashable]] = []
+        self.size = 0
+        self.nonempty = asyncio.Event()
+        self.arrival = asyncio.Event()
+
+    def qsize(self) -> int:
+        """Number of queued items."""
+        return self.size
+
+    def empty(self) -> bool:
+        """Return True if there are no queued items."""
+        return self.size == 0
+
+    def put_nowait(self, priority, shape: Hashable, item):
+        """Queue an item under the given shape."""
+        bucket = self.buckets.setdefault(shape, [])
+        if not bucket or priority < bucket[0][0]:
+            heapq.heappush(self.heads, (priority, shape))
+        heapq.heappush(bucket, (priority, item))
+        self.size += 1
+        self.nonempty.set()
+        self.arrival.set()
+
+    def _pop_head(self) -> Hashable:
+        """Remove and return the shape with the highest-priority item."""
+        while True:
+            priority, shape = heapq.heappop(self.heads)
+            bucket = self.buckets.get(shape)
+            if bucket and bucket[0][0] == priority:
+                return shape
+
+    def peek_nowait(self) -> tuple[Hashable, list[tuple[Any, Any]]]:
+        """
+        Return the highest-priority shape and its (unordered) bucket
+        without removing anything.
+        """
+        if self.size == 0:
+            raise asyncio.QueueEmpty()
+        shape = self._pop_head()
+        bucket = self.buckets[shape]
+        heapq.heappush(self.heads, (bucket[0][0], shape))
+        return shape, bucket
+
+    def revise(
+            self,
+            shape: Hashable,
+            revise: Callable[[Any, Any], Optional[Any]],
+    ) -> list[Any]:
+        """
+        Re-prioritize a shape's items.
+
+        revise is called with the priority and item of each and returns
+        the item's new priority, or None to remove it. Return the
+        removed items.
+        """
+        bucket = self.buckets.get(shape)
+        if not bucket:
+            return []
+        kept = []
+        removed = []
+        for priority, item in bucket:
+            priority = revise(priority, item)
+            if priority is None:
+                removed.append(item)
+            else:
+                kept.append((priority, item))
+        if kept:
+            heapq.heapify(kept)
+            self.buckets[shape] = kept
+            heapq.heappush(self.heads, (kept[0][0], shape))
+        else:
+            del self.buckets[shape]
+        self.size -= len(removed)
+        if self.size == 0:
+            self.nonempty.clear()
+        return removed
+
+    async def wait_for_arrival(self, timeout: float) -> bool:
+        """
+        Wait up to timeout seconds for another item to be queued.
+
+        Return True if one was.
+        """
+        self.arrival.clear()
+        try:
+            await asyncio.wait_for(self.arrival.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def get_batch_nowait(
+            self,
+            max_size: Optional[int] = None,
+            admit: Optional[Callable[[Any], bool]] = None,
+    ) -> tuple[Hashable, list[tuple[Any, Any]]]:
+        """
+        Remove the highest-priority shape's items and return them.
+
+        At most max_size items are taken, in priority order. If given,
+        admit is called with each item in turn, so that it can account for
+        it, and the batch ends at the first item it rejects. The first
+        item is always taken. The rest stay queued.
+        """
+        if self.size == 0:
+            raise asyncio.QueueEmpty()
+        shape = self._pop_head()
+        bucket = self.buckets[shape]
+        if admit is None and (max_size is None or len(bucket) <= max_size):
+            del self.buckets[shape]
+            batch = sorted(bucket, key=lambda entry: entry[0])
+        else:
+            batch = [heapq.heappop(bucket)]
+            if admit is not None:
+                admit(batch[0][1])
+            while bucket and (max_size is None or len(batch) < max_size):
+                if admit is not None and not admit(bucket[0][1]):
+                    break
+                batch.append(heapq.heappop(bucket))
+            if bucket:
+                heapq.heappush(self.heads, (bucket[0][0], shape))
+            else:
+                del self.buckets[shape]
+
+        self.size -= len(batch)
+        if self.size == 0:
+            self.nonempty.clear()
+        return shape, batch
+
+    async def wait(self):
+        """Wait until there is a queued item."""
+        while self.size == 0:
+            await self.nonempty.wait()
+
+    async def get_batch(
+            self,
+            max_size: Optional[int] = None,
+            admit: Optional[Callable[[Any], bool]] = None,
+    ) -> tuple[Hashable, list[tuple[Any, Any]]]:
+        """Wait for an item, then get a batch of its shape."""
+        await self.wait()
+        return self.get_batch_nowait(max_size, admit)
@@ -0,0 +1,109 @@
+"""Minimal client for the Redis protocol (RESP)."""
+import asyncio
+from typing import Any, Optional, Union
+from urllib.parse import urlparse
+
+
+class RedisError(Exception):
+    """Error reply from the server."""
+
+
+def encode_command(*args: Union[str, bytes, int, float]) -> bytes:
+    """Encode a command as an array of bulk strings."""
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if not isinstance(arg, bytes):
+            arg = str(arg).encode()
+        parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(parts)
+
+
+async def read_reply(reader: asyncio.StreamReader) -> Any:
+    """
+    Read a reply: simple strings and bulk strings are returned
+    as bytes, integers as int and arrays as lists.
+
+    Raises RedisError for error replies.
+    """
+    line = await reader.readline()
+    if not line.endswith(b"\r\n"):
+        raise ConnectionError("Connection closed by the server")
+    kind, body = line[:1], line[1:-2]
+    if kind == b"+":
+        return body
+    if kind == b"-":
+        raise RedisError(body.decode())
+    if kind == b":":
+        return int(body)
+    if kind == b"$":
+        length = int(body)
+        if length < 0:
+            return None
+        return (await reader.readexactly(length + 2))[:-2]
+    if kind == b"*":
+        length = int(body)
+        if length < 0:
+            return None
+        return [await read_reply(reader) for _ in range(length)]
+    raise ConnectionError(f"Unexpected reply {line!r}")
+
+
+class RESPClient():
+    """
+    One connection to a server speaking the Redis protocol,
+    given by a redis://[:password@]host[:port][/db] URL.
+
+    Commands are sent one at a time. The connection is opened on the
+    first command and again after any error, so that a reply that was
+    not read cannot be taken for that of the next command. Connecting
+    and each round trip time out after timeout seconds.
+    """
+
+    def __init__(self, url: str, timeout: float = 1.0):
+        """Initialize."""
+        parsed = urlparse(url)
+        if parsed.scheme != "redis":
+            raise ValueError(f"Expected a redis:// URL, got {url}")
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.strip("/") or 0)
+        self.timeout = timeout
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.lock = asyncio.Lock()
+
+    async def connect(self):
+        """Open the connection and select the database."""
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        if self.password:
+            await self.send("AUTH", self.password)
+        if self.db:
+            await self.send("SELECT", self.db)
+
+    async def send(self, *args) -> Any:
+        """Send a command over the open connection and read its reply."""
+        self.writer.write(encode_command(*args))
+        await self.writer.drain()
+        return await read_reply(self.reader)
+
+    async def execute(self, *args) -> Any:
+        """
+        Send a command and return its reply.
+
+        Raises asyncio.TimeoutError if the server takes too long.
+        """
+        async with self.lock:
+            try:
+                if self.writer is None:
+                    await asyncio.wait_for(self.connect(), self.timeout)
+                return await asyncio.wait_for(self.send(*args), self.timeout)
+            except BaseException:
+                self.close()
+                raise
+
+    def close(self):
+        """Close the connection."""
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
@@ -0,0 +1,199 @@
+"""JSON serialization, using orjson and ijson if they are installed."""
+from collections import defaultdict
+from collections.abc import AsyncIterator
+import json
+from json.decoder import JSONDecodeError
+from typing import Any, Optional, Union
+
+from .trapi import add_to_index, check_result
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import ijson
+except ImportError:  # pragma: no cover
+    ijson = None
+
+
+def loads(data: Union[bytes, str]) -> Any:
+    """
+    Decode JSON.
+
+    Raises a json.JSONDecodeError (orjson's errors are a subclass of it)
+    if the data is not valid JSON.
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj: Any) -> bytes:
+    """Encode JSON as UTF-8 bytes."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode()
+
+
+class FragmentMemo():
+    """
+    JSON encodings of objects shared between responses.
+
+    Objects are keyed by identity and kept alive with their encoding,
+    so they must not be modified once encoded.
+    """
+
+    def __init__(self):
+        """Initialize."""
+        self.fragments: dict[int, tuple[Any, bytes]] = dict()
+
+    def encode(self, obj: Any) -> bytes:
+        """Encode an object, or return its earlier encoding."""
+        entry = self.fragments.get(id(obj))
+        if entry is None:
+            entry = self.fragments[id(obj)] = (obj, dumps(obj))
+        return entry[1]
+
+
+def encode_object(items: list[tuple[str, bytes]]) -> bytes:
+    """Encode an object from its keys and encoded values."""
+    return b"{" + b",".join(
+        dumps(key) + b":" + value
+        for key, value in items
+    ) + b"}"
+
+
+class TRAPIResponse(dict):
+    """
+    TRAPI response whose knowledge graph nodes and edges and results
+    can be encoded through a memo shared with other responses, e.g. the
+    other responses split from the same KP response.
+
+    orjson encodes a whole response faster than the memo can be used
+    from Python, so the memo only pays off with the stdlib encoder.
+
+    Timings holds how long the request took in each stage, in seconds.
+    """
+
+    __slots__ = ("memo", "timings")
+
+    def __init__(
+            self,
+            response: dict,
+            memo: FragmentMemo,
+            timings: Optional[dict[str, float]] = None,
+    ):
+        """Initialize."""
+        super().__init__(response)
+        self.memo = memo
+        self.timings = timings or dict()
+
+    def encode(self) -> bytes:
+        """Encode as JSON."""
+        if orjson is not None:
+            return orjson.dumps(self)
+        return self.encode_fragments()
+
+    def encode_fragments(self) -> bytes:
+        """Encode as JSON, reusing the memo's fragments."""
+        return encode_object([
+            (key, self.encode_message(value) if key == "message" else dumps(value))
+            for key, value in self.items()
+        ])
+
+    def encode_message(self, message) -> bytes:
+        """Encode a message, reusing the memo's fragments."""
+        if not isinstance(message, dict):
+            return dumps(message)
+        items = []
+        for key, value in message.items():
+            if key == "knowledge_graph" and isinstance(value, dict):
+                items.append((key, encode_object([
+                    (
+                        kg_key,
+                        encode_object([
+                            (element_id, self.memo.encode(element))
+                            for element_id, element in elements.items()
+                        ]) if kg_key in ("nodes", "edges") and isinstance(elements, dict)
+                        else dumps(elements)
+                    )
+                    for kg_key, elements in value.items()
+                ])))
+            elif key == "results" and isinstance(value, list):
+                items.append((key, b"[" + b",".join(
+                    self.memo.encode(result) for result in value
+                ) + b"]"))
+            else:
+                items.append((key, dumps(value)))
+        return encode_object(items)
+
+
+class ChunkReader():
+    """
+    Read an async iterator of byte chunks like an async file.
+
+    Reads return at most the requested size so that ijson, which
+    collects the parse events of each read, works in small steps
+    even if the chunks are large.
+    """
+
+    def __init__(self, chunks: AsyncIterator[bytes]):
+        """Initialize."""
+        self.chunks = chunks.__aiter__()
+        self.buffer = memoryview(b"")
+
+    async def read(self, size: int = -1) -> bytes:
+        """Return up to size bytes, or b"" at the end."""
+        if size == 0:
+            # ijson reads nothing to find out whether we return bytes
+            return b""
+        if not self.buffer:
+            async for chunk in self.chunks:
+                if chunk:
+                    self.buffer = memoryview(chunk)
+                    break
+            else:
+                return b""
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return bytes(data)
+
+
+async def stream_response(
+        chunks: AsyncIterator[bytes],
+        check: bool = True,
+) -> tuple[Any, dict[tuple[str, str], list[int]]]:
+    """
+    Decode a TRAPI response from a byte stream, indexing its results
+    (see trapi.index_results) as each one is parsed.
+
+    Only the decoded response is kept in memory, never the whole raw
+    body, and equal strings in it are shared. The response is still
+    built in full, so this saves the memory of the raw body only. If check is true, each
+    result is checked as it is parsed (see trapi.check_result).
+    Requires ijson.
+    """
+    builder = ijson.ObjectBuilder()
+    index = defaultdict(list)
+    strings = dict()
+    position = 0
+    try:
+        async for prefix, event, value in ijson.parse_async(
+            ChunkReader(chunks),
+            use_float=True,
+        ):
+            if event == "map_key" or event == "string":
+                value = strings.setdefault(value, value)
+            builder.event(event, value)
+            if event == "end_map" and prefix == "message.results.item":
+                result = builder.value["message"]["results"][-1]
+                if check:
+                    check_result(result)
+                add_to_index(index, position, result)
+                position += 1
+    except ijson.JSONError as err:
+        raise JSONDecodeError(str(err), "", 0) from err
+    return builder.value, index
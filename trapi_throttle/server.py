@@ -1,20 +1,27 @@
 """Server routes"""
+import asyncio
 from functools import wraps
 from json.decoder import JSONDecodeError
 import logging
 import traceback
 import pprint
+from typing import Awaitable, Literal, Optional
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from fastapi.exceptions import HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 import httpx
 import pydantic
 from reasoner_pydantic import Query
-from starlette.responses import JSONResponse
+from starlette.responses import JSONResponse, PlainTextResponse, Response
 
+from .capture import Capture
 from .config import settings
+from .metrics import render as render_metrics
+from .serialization import TRAPIResponse, dumps, loads
 from .throttle import DuplicateError, Throttle
+from .timing import server_timing
+from .trapi import InvalidMessage, check_query
 from .utils import log_request, log_response
 
 LOGGER = logging.getLogger(__name__)
@@ -41,18 +48,54 @@ async def startup_event():
         settings.dict()
     )
     LOGGER.info(f" App Configuration:\n {pretty_config}")
-    APP.throttle = Throttle()
+    APP.throttle = Throttle(
+        max_connections=settings.max_connections,
+        max_keepalive_connections=settings.max_keepalive_connections,
+        keepalive_expiry=settings.keepalive_expiry,
+        http2=settings.http2,
+        tracing=settings.tracing,
+        limiter_dir=settings.limiter_dir,
+        limiter_url=settings.limiter_url,
+        limiter_timeout=settings.limiter_timeout,
+    )
+    APP.capture = Capture(settings.capture_file) if settings.capture_file else None
 
 
 @APP.on_event('shutdown')
 async def shutdown_event():
-    pass
+    await APP.throttle.__aexit__()
+    if APP.capture is not None:
+        await APP.capture.close()
 
 
 class KPInformation(pydantic.main.BaseModel):
     url: pydantic.AnyHttpUrl
     request_qty: int
     request_duration: float
+    # null means no limit
+    max_connections: Optional[int]
+    max_keepalive_connections: Optional[int]
+    keepalive_expiry: Optional[float]
+    max_batch_size: Optional[int]
+    max_curies_per_node: Optional[int]
+    max_request_bytes: Optional[int]
+    max_expected_results: Optional[int]
+    burst: Optional[int]
+    # these cannot be null
+    http2: bool = settings.http2
+    warmup: bool = False
+    max_in_flight: int = 1
+    linger: float = 0.0
+    adaptive_linger: bool = False
+    cache_size: int = 0
+    cache_ttl: float = 300.0
+    rate_limiter: Literal["gcra", "token_bucket"] = "gcra"
+    rate_decrease: float = 0.5
+    rate_increase: float = 1.0
+    validation: Literal["full", "structural", "none"] = "full"
+    streaming: bool = False
+    tracing: bool = settings.tracing
+    limiter_lease: int = 1
 
 
 def log_errors(fcn):
@@ -66,6 +109,15 @@ def log_errors(fcn):
     return wrapper
 
 
+@APP.get("/metrics")
+async def metrics():
+    """Get throttle metrics for all KPs in the Prometheus text format."""
+    return PlainTextResponse(
+        render_metrics(APP.throttle.servers),
+        media_type="text/plain; version=0.0.4",
+    )
+
+
 @APP.post("/register/{kp_id}")
 async def register_kp(
         kp_id: str,
@@ -90,14 +142,63 @@ async def unregister_kp(
     return {"status": "removed"}
 
 
-@APP.post('/{kp_id}/query')
-async def query(
+class FastJSONResponse(JSONResponse):
+    """
+    JSON response built from the pre-encoded parts of TRAPI
+    responses where possible, and encoded with orjson if it is installed.
+    """
+
+    def render(self, content) -> bytes:
+        if isinstance(content, TRAPIResponse):
+            return content.encode()
+        return dumps(content)
+
+
+async def unless_disconnected(request: Request, awaitable: Awaitable):
+    """
+    Await something, checking every disconnect_poll_interval seconds
+    whether the client is still connected, and cancel it if not.
+
+    Return None if it was cancelled.
+    """
+    if settings.disconnect_poll_interval <= 0:
+        return await awaitable
+    task = asyncio.ensure_future(awaitable)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=settings.disconnect_poll_interval)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                task.cancel()
+                return None
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+
+
+async def send_query(
         kp_id: str,
-        query: Query,
-) -> Query:
-    """ Queue up a query for batching and return when completed """
+        query: dict,
+        request: Request,
+) -> Response:
+    """
+    Send a query through the throttle and report KP errors.
+
+    If the client disconnects, the query is cancelled,
+    so that it is left out of, or cancels, its batch.
+    """
+    if APP.capture is not None:
+        APP.capture.record(kp_id, query)
     try:
-        return JSONResponse(await APP.throttle.query(kp_id, query.dict(exclude_unset=True)))
+        response = await unless_disconnected(request, APP.throttle.query(kp_id, query))
+        if response is None:
+            # nobody is listening; nginx's "client closed request"
+            return Response(status_code=499)
+        headers = None
+        if settings.server_timing and getattr(response, "timings", None):
+            headers = {"Server-Timing": server_timing(response.timings)}
+        return FastJSONResponse(response, headers=headers)
     except httpx.RequestError as e:
         return JSONResponse({
             "message": "Request Error contacting KP",
@@ -127,9 +228,44 @@ async def query(
         }, 502)
 
 
+if settings.raw_ingress:
+    @APP.post('/{kp_id}/query')
+    async def query(
+            kp_id: str,
+            request: Request,
+    ) -> Query:
+        """ Queue up a query for batching and return when completed """
+        try:
+            query = check_query(loads(await request.body()))
+        except (JSONDecodeError, InvalidMessage) as e:
+            raise HTTPException(422, str(e))
+        return await send_query(kp_id, query, request)
+else:
+    @APP.post('/{kp_id}/query')
+    async def query(
+            kp_id: str,
+            query: Query,
+            request: Request,
+    ) -> Query:
+        """ Queue up a query for batching and return when completed """
+        return await send_query(kp_id, query.dict(exclude_unset=True), request)
+
+
+@APP.get("/{kp_id}/batch_stats")
+async def batch_stats(kp_id: str):
+    """Get batch fill statistics for a KP."""
+    return APP.throttle.servers[kp_id].batch_stats()
+
+
+@APP.get("/{kp_id}/rate")
+async def rate(kp_id: str):
+    """Get the learned request rate for a KP."""
+    return APP.throttle.servers[kp_id].limiter.stats()
+
+
 @APP.get("/{kp_id}/meta_knowledge_graph")
 async def metakg(kp_id: str):
-    url = "/".join(APP.throttle.servers[kp_id].url.split("/")[:-1] + ["meta_knowledge_graph"])
-    async with httpx.AsyncClient() as client:
-        response = await client.get(url)
+    server = APP.throttle.servers[kp_id]
+    url = "/".join(server.url.split("/")[:-1] + ["meta_knowledge_graph"])
+    response = await server.client.get(url)
     return response.json()
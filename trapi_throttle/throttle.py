@@ -1,23 +1,42 @@
 """Server routes"""
 import asyncio
-from asyncio.queues import QueueEmpty
 from asyncio.tasks import Task
-import copy
+from collections import defaultdict
 import datetime
 from functools import wraps
 import itertools
+import json
 from json.decoder import JSONDecodeError
 import logging
+import math
+import os
+import time
 import traceback
-from typing import Callable, Optional, Union
+from typing import Callable, Literal, Optional, Union
+from urllib.parse import quote
 
 import httpx
 import pydantic
 from reasoner_pydantic import Response as ReasonerResponse
-import uuid
 
-from .trapi import BatchingError, get_curies, remove_curies, filter_by_curie_mapping
-from .utils import get_keys_with_value, log_request, log_response
+from .cache import ResultCache
+from .limiter import make_limiter
+from .metrics import KPMetrics
+from .request_queue import ShapeQueue
+from .serialization import FragmentMemo, TRAPIResponse, ijson, loads, stream_response
+from .timing import BatchTiming, breakdown, export_spans, trace
+from .trapi import (
+    BatchingError,
+    InvalidMessage,
+    check_response,
+    filter_by_curie_mapping,
+    fingerprint,
+    get_curies,
+    index_results,
+    merge_parts,
+    rename_bindings,
+)
+from .utils import ewma, invert, log_request, log_response, parse_retry_after
 
 LOGGER = logging.getLogger(__name__)
 
@@ -26,6 +45,103 @@ class KPInformation(pydantic.main.BaseModel):
     url: pydantic.AnyHttpUrl
     request_qty: int
     request_duration: datetime.timedelta
+    max_connections: Optional[int] = None
+    max_keepalive_connections: Optional[int] = None
+    keepalive_expiry: Optional[float] = 5.0
+    http2: bool = False
+    warmup: bool = False
+    max_in_flight: int = 1
+    max_batch_size: Optional[int] = None
+    max_curies_per_node: Optional[int] = None
+    max_request_bytes: Optional[int] = None
+    max_expected_results: Optional[int] = None
+    linger: float = 0.0
+    adaptive_linger: bool = False
+    cache_size: int = 0
+    cache_ttl: float = 300.0
+    rate_limiter: Literal["gcra", "token_bucket"] = "gcra"
+    burst: Optional[int] = None
+    rate_decrease: float = 0.5
+    rate_increase: float = 1.0
+    validation: Literal["full", "structural", "none"] = "full"
+    streaming: bool = False
+    tracing: bool = False
+    limiter_lease: int = 1
+
+
+class QueuedRequest():
+    """
+    A query waiting for a response from a KP.
+
+    Followers are identical queries that were coalesced onto this
+    one; they are answered from its response and are never queued.
+    """
+
+    __slots__ = (
+        "priority",
+        "payload",
+        "curie_mapping",
+        "shape",
+        "node_map",
+        "edge_map",
+        "key",
+        "deadline",
+        "future",
+        "followers",
+        "queued_at",
+        "batch",
+    )
+
+    def __init__(
+            self,
+            priority: tuple[float, int],
+            payload: dict,
+            curie_mapping: dict[str, list[str]],
+            shape: str,
+            node_map: dict[str, str],
+            edge_map: dict[str, str],
+            key: tuple,
+            deadline: Optional[float],
+            future: asyncio.Future,
+            queued_at: float,
+    ):
+        """Initialize."""
+        self.priority = priority
+        self.payload = payload
+        self.curie_mapping = curie_mapping
+        self.shape = shape
+        self.node_map = node_map
+        self.edge_map = edge_map
+        self.key = key
+        self.deadline = deadline
+        self.future = future
+        self.followers: list[QueuedRequest] = []
+        self.queued_at = queued_at
+        # timing of the (latest) batch the request was sent in
+        self.batch: Optional[BatchTiming] = None
+
+    @property
+    def qgraph(self) -> dict:
+        return self.payload["message"]["query_graph"]
+
+    def waiting(self, now: float) -> list["QueuedRequest"]:
+        """This request and its followers whose callers still wait for them."""
+        return [
+            request for request in (self, *self.followers)
+            if not request.future.done()
+            and (request.deadline is None or request.deadline > now)
+        ]
+
+
+def settle(future: asyncio.Future, value: Union[dict, Exception]):
+    """Set the result, or exception, of a future unless it is done."""
+    if future.done():
+        # the caller gave up
+        return
+    if isinstance(value, Exception):
+        future.set_exception(value)
+    else:
+        future.set_result(value)
 
 
 def log_errors(fcn):
@@ -39,6 +155,15 @@ def log_errors(fcn):
     return wrapper
 
 
+# How KP responses are checked: parsed by reasoner-pydantic, checked only for
+# the structure needed to split them (see trapi.check_response), or trusted
+VALIDATION_MODES = ("full", "structural", "none")
+
+
+# Priority of requests that cannot meet their deadline
+DEFERRED = math.inf
+
+
 async def anull(arg, *args, **kwargs):
     """Do nothing, asynchronously."""
     return arg
@@ -55,22 +180,108 @@ class ThrottledServer():
         request_duration: float,
         *args, 
         max_batch_size: Optional[int] = None,
+        max_curies_per_node: Optional[int] = None,
+        max_request_bytes: Optional[int] = None,
+        max_expected_results: Optional[int] = None,
+        linger: float = 0.0,
+        adaptive_linger: bool = False,
+        cache_size: int = 0,
+        cache_ttl: float = 300.0,
         timeout: float = 60.0,
         preproc: Callable = anull,
         postproc: Callable = anull,
         logger: logging.Logger = None,
+        max_connections: Optional[int] = None,
+        max_keepalive_connections: Optional[int] = None,
+        keepalive_expiry: Optional[float] = 5.0,
+        http2: bool = False,
+        warmup: bool = False,
+        max_in_flight: int = 1,
+        rate_limiter: str = "gcra",
+        burst: Optional[int] = None,
+        rate_decrease: float = 0.5,
+        rate_increase: float = 1.0,
+        validation: str = "full",
+        streaming: bool = False,
+        tracing: bool = False,
+        limiter_dir: Optional[str] = None,
+        limiter_url: Optional[str] = None,
+        limiter_lease: int = 1,
+        limiter_timeout: float = 1.0,
         **kwargs,
     ):
         """Initialize."""
         self.id = id
         self.worker: Optional[Task] = None
-        self.request_queue = asyncio.PriorityQueue()
+        self.client: Optional[httpx.AsyncClient] = None
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.http2 = http2
+        self.warmup = warmup
+        self.request_queue = ShapeQueue()
         self.counter = itertools.count()
         self.url = url
         self.request_qty = request_qty
         self.request_duration = datetime.timedelta(seconds=request_duration)
+        # The longest a 429 holds off requests
+        self.max_hold = max(request_duration, timeout or 0.0)
+        self.limiter = make_limiter(
+            rate_limiter,
+            request_qty,
+            self.request_duration,
+            burst,
+            # shared by every process that registers this KP id
+            state_file=(
+                os.path.join(limiter_dir, quote(id, safe="") + ".gcra")
+                if limiter_dir else None
+            ),
+            state_url=limiter_url,
+            key=f"trapi_throttle:{id}",
+            lease=limiter_lease,
+            state_timeout=limiter_timeout,
+            max_hold=self.max_hold,
+            decrease=rate_decrease,
+            increase=rate_increase,
+        )
+        self.max_in_flight = max_in_flight
+        if validation not in VALIDATION_MODES:
+            raise ValueError(
+                f"Unknown validation mode {validation}, expected one of {', '.join(VALIDATION_MODES)}"
+            )
+        self.validation = validation
+        if streaming and ijson is None:
+            raise ValueError("Streaming KP responses requires ijson")
+        self.streaming = streaming
+        if tracing and trace is None:
+            raise ValueError("Tracing requires opentelemetry-api")
+        self.tracing = tracing
+        self.batches: set[Task] = set()
         self.timeout = timeout
         self.max_batch_size = max_batch_size
+        self.max_curies_per_node = max_curies_per_node
+        self.max_request_bytes = max_request_bytes
+        self.max_expected_results = max_expected_results
+        self.linger_time = linger
+        self.adaptive_linger = adaptive_linger
+        # Exponentially weighted moving averages of the time
+        # between requests and of the KP response time
+        self.last_arrival: Optional[float] = None
+        self.arrival_gap: Optional[float] = None
+        self.latency: Optional[float] = None
+        self.results_per_curie: Optional[float] = None
+        self.cache = ResultCache(cache_size, cache_ttl) if cache_size > 0 else None
+        # Queued or in-flight queries by (shape, canonical curies)
+        self.pending: dict[tuple, QueuedRequest] = dict()
+        self.metrics = KPMetrics()
+        self.stats = {
+            "batches": 0,
+            "subrequests": 0,
+            "curies": 0,
+            "linger": 0.0,
+        }
         self.preproc = preproc
         self.postproc = postproc
         if logger is None:
@@ -81,181 +292,538 @@ class ThrottledServer():
     async def process_batch(
             self,
     ):
-        """Set up a subscriber to process batching"""
-        # Initialize the TAT
-        #
-        # TAT = Theoretical Arrival Time
-        # When the next request should be sent
-        # to adhere to the rate limit.
-        #
-        # This is an implementation of the GCRA algorithm
-        # More information can be found here:
-        # https://dev.to/astagi/rate-limiting-using-python-and-redis-58gk
-        if self.request_qty > 0:
-            interval = self.request_duration / self.request_qty
-            tat = datetime.datetime.utcnow() + interval
-
+        """Set up a subscriber to dispatch batches to the KP"""
+        in_flight = asyncio.Semaphore(self.max_in_flight)
+        batch_ids = itertools.count()
         while True:
-            # Get everything in the stream or wait for something to show up
-            priority, (request_id, payload, response_queue) = await self.request_queue.get()
-            priorities = {
-                request_id: priority
-            }
-            request_value_mapping = {
-                request_id: payload
-            }
-            response_queues = {
-                request_id: response_queue
-            }
-            while True:
-                if self.max_batch_size is not None and len(request_value_mapping) == self.max_batch_size:
-                    break
-                try:
-                    priority, (request_id, payload, response_queue) = self.request_queue.get_nowait()
-                except QueueEmpty:
-                    break
-                priorities[request_id] = priority
-                request_value_mapping[request_id] = payload
-                response_queues[request_id] = response_queue
+            # Wait for something to show up, a free in-flight slot,
+            # and the linger window, which lasts at least until the
+            # rate limit allows the next request. Requests that
+            # arrive in the meantime join the batch.
+            await self.request_queue.wait()
+            first_arrival = time.monotonic()
+            self.prune_queue()
+            if self.request_queue.empty():
+                continue
+            await in_flight.acquire()
+            timing = BatchTiming(next(batch_ids))
+            timing.linger_start = time.monotonic()
+            await self.linger(first_arrival)
+            # Callers may have given up while we waited
+            self.prune_queue()
+            if self.request_queue.empty():
+                in_flight.release()
+                continue
+            timing.rate_limit_start = time.monotonic()
+            await self.limiter.acquire()
+            timing.rate_limit_end = time.monotonic()
+            self.metrics.rate_limit_wait.observe(timing.rate_limit_end - timing.rate_limit_start)
+            # ... or while we waited for the rate limit
+            self.prune_queue()
+            if self.request_queue.empty():
+                self.limiter.refund()
+                in_flight.release()
+                continue
 
-            LOGGER.debug(
-                f"Processing batch of size {len(request_value_mapping)} for KP {self.id}"
+            # Take the queued requests of the
+            # highest-priority query graph shape
+            shape, batch = self.request_queue.get_batch_nowait(
+                self.max_batch_size,
+                self.batch_admitter(),
             )
 
-            # Extract a curie mapping from each request
-            request_curie_mapping = {
-                request_id: get_curies(request_value["message"]["query_graph"])
-                for request_id, request_value in request_value_mapping.items()
-            }
+            task = asyncio.create_task(self.send_batch(shape, batch, timing))
+            self.batches.add(task)
+            task.add_done_callback(self.batches.discard)
+            task.add_done_callback(lambda _: in_flight.release())
+
+    def prune_queue(self):
+        """
+        Drop queued requests whose callers have all given up (cancelled
+        or past their deadline), and move requests that cannot be answered
+        before their deadline, at the KP latency seen so far, behind the
+        others, so that they only use rate budget that is left over.
+
+        Only the shapes that are next in line are looked at, until the
+        first request of the next batch is worth sending.
+        """
+        now = time.monotonic()
+
+        def revise(priority, request: QueuedRequest):
+            waiting = request.waiting(now)
+            if not waiting:
+                return None
+            if (
+                self.latency is not None
+                and request.priority[0] != DEFERRED
+                and all(
+                    member.deadline is not None and member.deadline - now < self.latency
+                    for member in waiting
+                )
+            ):
+                self.metrics.deferred.inc()
+                request.priority = (DEFERRED, request.priority[1])
+            return request.priority
+
+        while not self.request_queue.empty():
+            shape, bucket = self.request_queue.peek_nowait()
+            if revise(*bucket[0]) == bucket[0][0]:
+                break
+            for request in self.request_queue.revise(shape, revise):
+                self.drop(request)
 
-            # Find requests that are the same (those that we can merge)
-            # This disregards non-matching IDs because the IDs have been
-            # removed with the extract_curie method
-            stripped_qgraphs = {
-                request_id: remove_curies(request["message"]["query_graph"])
-                for request_id, request in request_value_mapping.items()
+    def drop(self, request: QueuedRequest):
+        """Drop a queued request that nobody waits for."""
+        self.metrics.dropped.inc()
+        self.forget(request)
+
+    def forget(self, request: QueuedRequest):
+        """Stop coalescing identical queries onto a request."""
+        if self.pending.get(request.key) is request:
+            del self.pending[request.key]
+
+    async def linger(
+            self,
+            since: float,
+    ):
+        """
+        Wait for more requests of the next batch's shape to arrive.
+
+        Lingering lasts up to linger_time seconds after the first request
+        showed up, or until the rate limit lets the next request through if
+        that is later, so time spent waiting for an in-flight slot or the rate
+        limit counts against it. The rate slot itself is only taken after
+        lingering. It ends early when the batch is full or, once the KP
+        latency has been measured, when the earliest deadline of the batch's
+        requests less that latency comes up. With adaptive lingering we do
+        not linger while requests arrive further apart than the linger window.
+        """
+        if self.linger_time <= 0:
+            return
+        if self.adaptive_linger and (
+            self.arrival_gap is None or self.arrival_gap > self.linger_time
+        ):
+            return
+        start = time.monotonic()
+        while True:
+            _, bucket = self.request_queue.peek_nowait()
+            if self.max_batch_size is not None and len(bucket) >= self.max_batch_size:
+                break
+            until = max(since + self.linger_time, self.limiter.next_slot())
+            if self.latency is not None:
+                until = min([until] + [
+                    request.deadline - self.latency
+                    for _, request in bucket
+                    if request.deadline is not None
+                ])
+            remaining = until - time.monotonic()
+            if remaining <= 0:
+                break
+            if not await self.request_queue.wait_for_arrival(remaining):
+                break
+        self.stats["linger"] += time.monotonic() - start
+
+    def batch_admitter(self) -> Optional[Callable]:
+        """
+        Build a function that admits requests into a batch while the
+        merged request stays within this KP's curie, size and expected
+        result limits.
+
+        Expected results are estimated from the results per curie
+        seen in past responses.
+        """
+        if (
+            self.max_curies_per_node is None
+            and self.max_request_bytes is None
+            and self.max_expected_results is None
+        ):
+            return None
+
+        node_curies = defaultdict(set)
+        request_bytes = 0
+
+        def admit(request: QueuedRequest) -> bool:
+            nonlocal request_bytes
+            node_map = request.node_map
+            first = request_bytes == 0
+            new_curies = {
+                node_map[node_id]: set(curies) - node_curies[node_map[node_id]]
+                for node_id, curies in request.curie_mapping.items()
             }
-            first_value = next(iter(stripped_qgraphs.values()))
+            if first:
+                new_bytes = len(json.dumps(request.payload))
+            else:
+                # quotes, comma and space around each curie
+                new_bytes = sum(
+                    len(curie) + 4
+                    for curies in new_curies.values()
+                    for curie in curies
+                )
+
+            if not first:
+                if self.max_curies_per_node is not None and any(
+                    len(node_curies[node_id]) + len(curies) > self.max_curies_per_node
+                    for node_id, curies in new_curies.items()
+                ):
+                    return False
+                if (
+                    self.max_request_bytes is not None
+                    and request_bytes + new_bytes > self.max_request_bytes
+                ):
+                    return False
+                if (
+                    self.max_expected_results is not None
+                    and self.results_per_curie is not None
+                    and self.results_per_curie * (
+                        sum(len(curies) for curies in node_curies.values())
+                        + sum(len(curies) for curies in new_curies.values())
+                    ) > self.max_expected_results
+                ):
+                    return False
+
+            for node_id, curies in new_curies.items():
+                node_curies[node_id].update(curies)
+            request_bytes += new_bytes
+            return True
+
+        return admit
+
+    def validate(self, response) -> dict:
+        """
+        Check a decoded KP response according to the validation mode.
+
+        Streamed responses are only checked structurally, since full
+        validation would build a second copy of the response.
+        """
+        if self.validation == "full" and not self.streaming:
+            return ReasonerResponse.parse_obj(response).dict()
+        if self.validation != "none":
+            return check_response(response)
+        return response
 
-            batch_request_ids = get_keys_with_value(
-                stripped_qgraphs,
-                first_value,
+    def batch_stats(self) -> dict[str, Optional[float]]:
+        """Summarize how full batches have been."""
+        batches = self.stats["batches"] or 1
+        return {
+            "batches": self.stats["batches"],
+            "mean_subrequests": self.stats["subrequests"] / batches,
+            "mean_curies": self.stats["curies"] / batches,
+            "mean_fill": (
+                self.stats["subrequests"] / batches / self.max_batch_size
+                if self.max_batch_size else None
+            ),
+            "mean_linger": self.stats["linger"] / batches,
+            "cache_hits": self.cache.hits if self.cache else 0,
+            "cache_misses": self.cache.misses if self.cache else 0,
+        }
+
+    def split_cached(
+            self,
+            shape: str,
+            message: Optional[dict],
+            index: Optional[dict],
+            pinned_id: str,
+            sent_curies: list[str],
+            cached_parts: dict[str, tuple[dict, list[dict]]],
+            requests: list[QueuedRequest],
+    ) -> dict[QueuedRequest, Union[dict, Exception]]:
+        """
+        Split a KP response per curie, cache the parts and
+        assemble each request's response from its curies' parts.
+
+        Parts, including those of curies without results, are cached with
+        bindings in terms of the canonical qnode/qedge ids. The message is
+        None if all curies were cached.
+        """
+        template = requests[0]
+        parts = dict(cached_parts)
+        try:
+            for curie in sent_curies:
+                kgraph, results = filter_by_curie_mapping(
+                    message,
+                    {pinned_id: [curie]},
+                    kp_id=self.id,
+                    index=index,
+                )
+                parts[curie] = (
+                    kgraph,
+                    rename_bindings(results, template.node_map, template.edge_map),
+                )
+                self.cache.put((shape, curie), parts[curie])
+        except BatchingError as err:
+            # the response is probably malformed
+            return {request: err for request in requests}
+
+        response_values = dict()
+        for request in requests:
+            (curies,) = request.curie_mapping.values()
+            response_values[request] = self.assemble(
+                request.qgraph,
+                [parts[curie] for curie in curies],
+                request.node_map,
+                request.edge_map,
             )
-            
-            # Re-queue the un-selected requests
-            for request_id in request_value_mapping:
-                if request_id not in batch_request_ids:
-                    await self.request_queue.put((
-                        priorities[request_id],
-                        (
-                            request_id,
-                            request_value_mapping[request_id],
-                            response_queues[request_id],
-                        )
-                    ))
+        return response_values
 
-            request_value_mapping = {
-                k: v for k, v in request_value_mapping.items()
-                if k in batch_request_ids
+    def assemble(
+            self,
+            qgraph: dict,
+            parts: list[tuple[dict, list[dict]]],
+            node_map: dict[str, str],
+            edge_map: dict[str, str],
+    ) -> dict:
+        """Build a response from per-curie parts with canonical bindings."""
+        kgraph, results = merge_parts(parts)
+        return {
+            "message": {
+                "query_graph": qgraph,
+                "knowledge_graph": kgraph,
+                "results": rename_bindings(results, invert(node_map), invert(edge_map)),
             }
+        }
 
-            # Filter curie mapping to only include matching requests
-            request_curie_mapping = {
-                k: v for k, v in request_curie_mapping.items()
-                if k in batch_request_ids
-            }
+    @log_errors
+    async def send_batch(
+            self,
+            shape: str,
+            batch: list,
+            timing: BatchTiming,
+    ):
+        """Merge a batch, send it to the KP and split the response"""
+        # Leave out requests whose callers left since they were queued
+        now = time.monotonic()
+        requests: list[QueuedRequest] = []
+        for _, request in batch:
+            if request.waiting(now):
+                requests.append(request)
+            else:
+                self.drop(request)
+        if not requests:
+            # Nothing is sent, so the rate slot is not used
+            self.limiter.refund()
+            return
+        for request in requests:
+            request.batch = timing
 
-            # Pull first value from request_value_mapping
-            # to use as a template for our merged request
-            merged_request_value = copy.deepcopy(
-                next(iter(request_value_mapping.values()))
+        requeued = False
+        try:
+            LOGGER.debug(
+                f"Processing batch of size {len(requests)} for KP {self.id}"
             )
 
-            # Remove qnode ids
-            for qnode in merged_request_value["message"]["query_graph"]["nodes"].values():
-                qnode.pop("ids", None)
+            # Use the first request as a template for our merged request
+            template = requests[0]
+            template_value = template.payload
+            template_qgraph = template.qgraph
+            canonical_nodes = invert(template.node_map)
+            canonical_edges = invert(template.edge_map)
+
+            # Find how to rename each request's qnodes and qedges
+            # to those of the template, where they differ, and
+            # express its curie mapping in terms of the template's qnodes
+            request_renaming = dict()
+            request_curie_mapping = dict()
+            for request in requests:
+                if request.node_map == template.node_map and request.edge_map == template.edge_map:
+                    request_curie_mapping[request] = request.curie_mapping
+                    continue
+                node_renaming = {
+                    node_id: canonical_nodes[canonical_id]
+                    for node_id, canonical_id in request.node_map.items()
+                }
+                request_renaming[request] = (
+                    node_renaming,
+                    {
+                        edge_id: canonical_edges[canonical_id]
+                        for edge_id, canonical_id in request.edge_map.items()
+                    },
+                )
+                request_curie_mapping[request] = {
+                    node_renaming[node_id]: curies
+                    for node_id, curies in request.curie_mapping.items()
+                }
 
-            # Update merged request using curie mapping
+            # Build the merged query graph from (shallow) copies
+            # of the template's qnodes and qedges
+            merged_ids = defaultdict(dict)
             for curie_mapping in request_curie_mapping.values():
                 for node_id, node_curies in curie_mapping.items():
-                    node = merged_request_value["message"]["query_graph"]["nodes"][node_id]
-                    if "ids" not in node:
-                        node["ids"] = []
-                    node["ids"].extend(node_curies)
-            for qnode in merged_request_value["message"]["query_graph"]["nodes"].values():
-                if qnode.get("ids"):
-                    qnode["ids"] = list(set(qnode["ids"]))
+                    merged_ids[node_id].update(dict.fromkeys(node_curies))
+
+            # With a single pinned qnode, results can be cached per curie.
+            # Only the curies that are not cached are sent to the KP.
+            cached_parts = None
+            if (
+                self.cache is not None
+                and len(merged_ids) == 1
+                and any(merged_ids.values())
+            ):
+                (pinned_id, pinned_curies), = merged_ids.items()
+                cached_parts = dict()
+                for curie in pinned_curies:
+                    part = self.cache.get((shape, curie))
+                    if part is not None:
+                        cached_parts[curie] = part
+                merged_ids[pinned_id] = {
+                    curie: None
+                    for curie in pinned_curies
+                    if curie not in cached_parts
+                }
+            merged_request_value = {
+                **template_value,
+                "message": {
+                    **template_value["message"],
+                    "query_graph": {
+                        **template_qgraph,
+                        "nodes": {
+                            node_id: {
+                                **{
+                                    key: value
+                                    for key, value in qnode.items()
+                                    if key != "ids"
+                                },
+                                **(
+                                    {"ids": list(merged_ids[node_id])}
+                                    if node_id in merged_ids else {}
+                                ),
+                            }
+                            for node_id, qnode in template_qgraph["nodes"].items()
+                        },
+                        "edges": {
+                            edge_id: dict(qedge)
+                            for edge_id, qedge in template_qgraph["edges"].items()
+                        },
+                    },
+                },
+            }
 
             response_values = dict()
             try:
-                # Make request
-                self.logger.info("[{id}] Sending request made of {subrequests} subrequests ({curies} curies)".format(
-                    id = self.id,
-                    subrequests=len(request_curie_mapping),
-                    curies=" x ".join(
-                        str(len(qnode.get("ids", []) or []))
-                        for qnode in merged_request_value["message"]["query_graph"]["nodes"].values()
-                    ),
-                ))
-                self.logger.context = self.id
-                merged_request_value = await self.preproc(merged_request_value, self.logger)
-                async with httpx.AsyncClient() as client:
-                    response = await client.post(
-                        self.url,
-                        json=merged_request_value,
-                        timeout=self.timeout,
-                    )
-                if response.status_code == 429:
-                    # reset TAT
-                    interval = self.request_duration / self.request_qty
-                    tat = (datetime.datetime.utcnow() + interval)
-                    # re-queue requests
-                    for request_id in request_value_mapping:
-                        await self.request_queue.put((
-                            priorities[request_id],
-                            (
-                                request_id,
-                                request_value_mapping[request_id],
-                                response_queues[request_id],
-                            )
+                message, index = None, None
+                if cached_parts is not None and not merged_ids[pinned_id]:
+                    # Every curie was cached, so the rate slot is not used
+                    self.limiter.refund()
+                else:
+                    # Make request
+                    self.logger.info("[{id}] Sending request made of {subrequests} subrequests ({curies} curies)".format(
+                        id = self.id,
+                        subrequests=len(request_curie_mapping),
+                        curies=" x ".join(
+                            str(len(qnode.get("ids", []) or []))
+                            for qnode in merged_request_value["message"]["query_graph"]["nodes"].values()
+                        ),
+                    ))
+                    self.logger.context = self.id
+                    merged_request_value = await self.preproc(merged_request_value, self.logger)
+                    n_curies = sum(len(curies) for curies in merged_ids.values())
+                    self.stats["batches"] += 1
+                    self.stats["subrequests"] += len(request_curie_mapping)
+                    self.stats["curies"] += n_curies
+                    self.metrics.batch_subrequests.observe(len(request_curie_mapping))
+                    self.metrics.batch_curies.observe(n_curies)
+                    timing.sent = time.monotonic()
+                    posted = await self.post_while_waited(merged_request_value, requests)
+                    if posted is None:
+                        self.metrics.abandoned.inc()
+                        self.logger.info(f"[{self.id}] Cancelled request, all callers left")
+                        return
+                    response, data, index = posted
+                    timing.received = time.monotonic()
+                    elapsed = timing.received - timing.sent
+                    self.latency = ewma(self.latency, elapsed)
+                    self.metrics.kp_latency.observe(elapsed)
+                    if response.status_code == 429:
+                        self.metrics.rate_limited.inc()
+                        self.metrics.requeued.inc(len(requests))
+                        # hold off and slow down
+                        self.limiter.penalize(parse_retry_after(
+                            response.headers.get("Retry-After"),
+                            self.max_hold,
                         ))
-                    # try again later
-                    continue
+                        self.logger.warning(
+                            f"[{self.id}] Rate limited, slowing down to "
+                            f"{self.limiter.rate:.3g} requests per second"
+                        )
+                        # re-queue requests
+                        for request in requests:
+                            self.request_queue.put_nowait(request.priority, shape, request)
+                        requeued = True
+                        # try again later
+                        return
+
+                    response.raise_for_status()
+                    self.limiter.recover()
+
+                    response = self.validate(data)
+                    del data
+                    response = await self.postproc(response)
+                    message = response["message"]
+                    results = message.get("results") or []
+                    self.logger.info(f"[{self.id}] Received response with {len(results)} results")
+                    if n_curies:
+                        self.results_per_curie = ewma(
+                            self.results_per_curie,
+                            len(results) / n_curies,
+                        )
 
-                response.raise_for_status()
-
-                # Parse with reasoner_pydantic to validate
-                response = ReasonerResponse.parse_obj(response.json()).dict()
-                response = await self.postproc(response)
-                message = response["message"]
-                results = message.get("results") or []
-                self.logger.info(f"[{self.id}] Received response with {len(results)} results")
-
-                # Split using the request_curie_mapping
-                for request_id, curie_mapping in request_curie_mapping.items():
-                    try:
-                        kgraph, results = filter_by_curie_mapping(message, curie_mapping, kp_id=self.id)
-                        response_values[request_id] = {
-                            "message": {
-                                "query_graph": request_value_mapping[request_id]["message"]["query_graph"],
-                                "knowledge_graph": kgraph,
-                                "results": results,
+                    if index is None or self.postproc is not anull:
+                        index = index_results(results)
+
+                split_start = time.monotonic()
+                if cached_parts is not None:
+                    response_values = self.split_cached(
+                        shape,
+                        message,
+                        index,
+                        pinned_id,
+                        list(merged_ids[pinned_id]),
+                        cached_parts,
+                        requests,
+                    )
+                else:
+                    # Split using the request_curie_mapping
+                    for request, curie_mapping in request_curie_mapping.items():
+                        try:
+                            kgraph, results = filter_by_curie_mapping(
+                                message,
+                                curie_mapping,
+                                kp_id=self.id,
+                                index=index,
+                            )
+                            if request in request_renaming:
+                                # Rename bindings back to the request's own qgraph ids
+                                node_renaming, edge_renaming = request_renaming[request]
+                                results = rename_bindings(
+                                    results,
+                                    invert(node_renaming),
+                                    invert(edge_renaming),
+                                )
+                            response_values[request] = {
+                                "message": {
+                                    "query_graph": request.qgraph,
+                                    "knowledge_graph": kgraph,
+                                    "results": results,
+                                }
                             }
-                        }
-                    except BatchingError as err:
-                        # the response is probably malformed
-                        response_values[request_id] = err
+                        except BatchingError as err:
+                            # the response is probably malformed
+                            response_values[request] = err
+                timing.split = time.monotonic()
+                self.metrics.split_time.observe(timing.split - split_start)
             except (
                 asyncio.exceptions.TimeoutError,
                 httpx.RequestError,
                 httpx.HTTPStatusError,
                 JSONDecodeError,
                 pydantic.ValidationError,
+                InvalidMessage,
             ) as e:
-                for request_id, curie_mapping in request_curie_mapping.items():
-                    response_values[request_id] = {
-                        "message": request_value_mapping[request_id]["message"],
+                for request in requests:
+                    response_values[request] = {
+                        "message": request.payload["message"],
                     }
+                if isinstance(e, (asyncio.TimeoutError, httpx.TimeoutException)):
+                    self.metrics.timeouts.inc()
                 if isinstance(e, asyncio.TimeoutError):
                     self.logger.warning({
                         "message": f"{self.id} took >60 seconds to respond",
@@ -287,11 +855,12 @@ class ThrottledServer():
                     # Log error with response
                     self.logger.warning({
                         "message": f"Received bad JSON data from {self.id}",
-                        "request": e.request,
-                        "response": e.response.text,
+                        "request": log_request(e.response.request),
+                        # streamed responses are not kept
+                        "response": None if self.streaming else e.response.text,
                         "error": str(e),
                     })
-                elif isinstance(e, pydantic.ValidationError):
+                elif isinstance(e, (pydantic.ValidationError, InvalidMessage)):
                     self.logger.warning({
                         "message": f"Received non-TRAPI compliant response from {self.id}",
                         "error": str(e),
@@ -302,26 +871,188 @@ class ThrottledServer():
                         "error": str(e),
                     })
 
-            for request_id, response_value in response_values.items():
-                # Write finished value to DB
-                await response_queues[request_id].put(response_value)
+            # Responses share the encodings of their knowledge graph
+            # nodes and edges and results
+            memo = FragmentMemo()
+            for request, response_value in response_values.items():
+                if not isinstance(response_value, Exception):
+                    response_value = TRAPIResponse(response_value, memo)
+                self.resolve(request, response_value)
 
-            # if request_qty == 0 we don't enforce the rate limit
-            if self.request_qty > 0:
-                time_remaining_seconds = (tat - datetime.datetime.utcnow()).total_seconds()
+            if self.tracing:
+                export_spans(self.id, timing, [
+                    request.queued_at
+                    for leader in requests
+                    for request in [leader, *leader.followers]
+                ])
+        except Exception as err:
+            # Answer every caller rather than leave them to time out
+            traceback.print_exc()
+            self.logger.error({
+                "message": f"Something went wrong while processing a batch for {self.id}",
+                "error": repr(err),
+            })
+            error = BatchingError(f"Failed to process batch for {self.id}: {err!r}")
+            error.__cause__ = err
+            for request in requests:
+                for member in (request, *request.followers):
+                    settle(member.future, error)
+        finally:
+            # Identical queries must not attach to a request that is done
+            if not requeued:
+                for request in requests:
+                    self.forget(request)
 
-                # Wait for TAT
-                if time_remaining_seconds > 0:
-                    LOGGER.debug(f"Waiting {time_remaining_seconds} seconds")
-                    await asyncio.sleep(time_remaining_seconds)
+    def resolve(
+            self,
+            request: QueuedRequest,
+            response_value: Union[TRAPIResponse, Exception],
+    ):
+        """
+        Answer a request and the identical queries
+        that were coalesced onto it.
 
-                # Update TAT
-                tat = datetime.datetime.utcnow() + interval
+        Each follower gets its own top-level message with its own
+        query graph. The knowledge graph and results are shared
+        (and only copied if the follower's qnode/qedge ids differ).
+        """
+        self.forget(request)
+        if not isinstance(response_value, Exception):
+            response_value.timings = breakdown(request.queued_at, request.batch)
+        settle(request.future, response_value)
+        for follower in request.followers:
+            if isinstance(response_value, Exception):
+                settle(follower.future, response_value)
+                continue
+            message = {
+                **response_value["message"],
+                "query_graph": follower.qgraph,
+            }
+            if (
+                "results" in message
+                and (follower.node_map, follower.edge_map) != (request.node_map, request.edge_map)
+            ):
+                canonical_nodes = invert(follower.node_map)
+                canonical_edges = invert(follower.edge_map)
+                message["results"] = rename_bindings(
+                    message["results"],
+                    {
+                        node_id: canonical_nodes[canonical_id]
+                        for node_id, canonical_id in request.node_map.items()
+                    },
+                    {
+                        edge_id: canonical_edges[canonical_id]
+                        for edge_id, canonical_id in request.edge_map.items()
+                    },
+                )
+            settle(follower.future, TRAPIResponse(
+                {**response_value, "message": message},
+                response_value.memo,
+                breakdown(follower.queued_at, request.batch),
+            ))
+
+    async def post_while_waited(
+            self,
+            payload: dict,
+            requests: list[QueuedRequest],
+    ) -> Optional[tuple[httpx.Response, Optional[dict], Optional[dict]]]:
+        """
+        Post a request to the KP (see post) unless, or until, every
+        caller of the given requests has left.
+
+        Return None if the request was cancelled because of that.
+        """
+        abandoned = asyncio.Event()
+
+        def check(_):
+            now = time.monotonic()
+            if not any(request.waiting(now) for request in requests):
+                abandoned.set()
+
+        futures = [
+            member.future
+            for request in requests
+            for member in (request, *request.followers)
+        ]
+        for future in futures:
+            future.add_done_callback(check)
+        check(None)
+        posting = asyncio.ensure_future(self.post(payload))
+        leaving = asyncio.ensure_future(abandoned.wait())
+        try:
+            await asyncio.wait({posting, leaving}, return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            posting.cancel()
+            raise
+        finally:
+            for future in futures:
+                future.remove_done_callback(check)
+            leaving.cancel()
+        if not posting.done():
+            posting.cancel()
+            try:
+                await posting
+            except asyncio.CancelledError:
+                return None
+        return posting.result()
+
+    async def post(
+            self,
+            payload: dict,
+    ) -> tuple[httpx.Response, Optional[dict], Optional[dict]]:
+        """
+        Send a request to the KP.
+
+        Return the response and, unless it is an error, its decoded body.
+        When streaming, the body is decoded as it arrives and an index of
+        its results is returned as well; otherwise the index is None.
+
+        JSON decoding errors carry the response.
+        """
+        if not self.streaming:
+            response = await self.client.post(
+                self.url,
+                json=payload,
+                timeout=self.timeout,
+            )
+            if response.is_error:
+                return response, None, None
+            try:
+                return response, loads(response.content), None
+            except JSONDecodeError as err:
+                err.response = response
+                raise
+
+        async with self.client.stream(
+            "POST",
+            self.url,
+            json=payload,
+            timeout=self.timeout,
+        ) as response:
+            if response.is_error:
+                await response.aread()
+                return response, None, None
+            try:
+                data, index = await stream_response(
+                    response.aiter_bytes(),
+                    check=self.validation != "none",
+                )
+            except JSONDecodeError as err:
+                err.response = response
+                raise
+            return response, data, index
 
     async def __aenter__(
             self,
     ):
         """Set KP info and start processing task."""
+        self.client = httpx.AsyncClient(
+            limits=self.limits,
+            http2=self.http2,
+        )
+        if self.warmup:
+            await self.warm_up()
+
         loop = asyncio.get_event_loop()
         self.worker = loop.create_task(self.process_batch())
 
@@ -342,6 +1073,27 @@ class ThrottledServer():
         except asyncio.CancelledError:
             LOGGER.debug(f"Task cancelled: {task}")
 
+        # Cancel in-flight batches
+        for batch in list(self.batches):
+            batch.cancel()
+        await asyncio.gather(*self.batches, return_exceptions=True)
+
+        client: httpx.AsyncClient = self.client
+        self.client = None
+        await client.aclose()
+        self.limiter.close()
+
+    async def warm_up(self):
+        """Open a connection to the KP ahead of the first batch.
+
+        Any response, including an error status, leaves a connection
+        in the pool; failures are only logged.
+        """
+        try:
+            await self.client.head(self.url, timeout=self.timeout)
+        except httpx.HTTPError as err:
+            LOGGER.debug(f"Unable to warm up connection to {self.id}: {err}")
+
     async def query(
             self,
             query: dict,
@@ -352,25 +1104,69 @@ class ThrottledServer():
         if self.worker is None:
             raise RuntimeError("Cannot send a request until a worker is running - enter the context")
 
-        request_id = str(uuid.uuid1())
-        response_queue = asyncio.Queue()
+        now = time.monotonic()
+        if self.last_arrival is not None:
+            self.arrival_gap = ewma(self.arrival_gap, now - self.last_arrival)
+        self.last_arrival = now
+        deadline = None if timeout is None else now + timeout
 
-        # Queue query for processing
-        await self.request_queue.put((
-            (priority, next(self.counter)),
-            (request_id, query, response_queue),
-        ))
+        qgraph = query["message"]["query_graph"]
+        shape, node_map, edge_map = fingerprint(qgraph)
+        curie_mapping = get_curies(qgraph)
 
-        # Wait for response
-        output: Union[dict, Exception] = await asyncio.wait_for(
-            response_queue.get(),
-            timeout=timeout,
+        # Answer from the cache if we can
+        if self.cache is not None:
+            if len(curie_mapping) == 1:
+                (curies,) = curie_mapping.values()
+                # Look each curie up once, since entries
+                # can expire or be evicted in between
+                parts = [self.cache.get((shape, curie)) for curie in curies]
+                if curies and all(part is not None for part in parts):
+                    return TRAPIResponse(self.assemble(
+                        qgraph,
+                        parts,
+                        node_map,
+                        edge_map,
+                    ), FragmentMemo())
+
+        request = QueuedRequest(
+            (priority, next(self.counter)),
+            query,
+            curie_mapping,
+            shape,
+            node_map,
+            edge_map,
+            (shape, tuple(sorted(
+                (node_map[node_id], tuple(sorted(set(curies))))
+                for node_id, curies in curie_mapping.items()
+            ))),
+            deadline,
+            asyncio.get_running_loop().create_future(),
+            now,
         )
 
-        if isinstance(output, Exception):
-            raise output
+        # Attach to an identical pending query if there is one
+        if request.key in self.pending:
+            leader = self.pending[request.key]
+            leader.followers.append(request)
+            if leader.priority[0] == DEFERRED and (
+                self.latency is None
+                or deadline is None
+                or deadline - now >= self.latency
+            ):
+                # The follower can still be answered in time,
+                # so the request goes back in line if it is queued
+                leader.priority = (priority, leader.priority[1])
+                self.request_queue.revise(shape, lambda _, queued: queued.priority)
+        else:
+            self.pending[request.key] = request
 
-        return output
+            # Queue query for processing, keyed by the fingerprint of its
+            # query graph so that it can be batched with its peers
+            self.request_queue.put_nowait(request.priority, shape, request)
+
+        # Wait for response
+        return await asyncio.wait_for(request.future, timeout=timeout)
 
     
 class DuplicateError(Exception):
@@ -381,8 +1177,13 @@ class Throttle():
     """TRAPI Throttle."""
 
     def __init__(self, *args, **kwargs):
-        """Initialize."""
+        """Initialize.
+
+        Keyword arguments are used as defaults for every registered
+        KP, e.g. connection pool settings.
+        """
         self.servers: dict[str, ThrottledServer] = dict()
+        self.server_defaults = kwargs
 
     async def register_kp(
             self,
@@ -392,7 +1193,10 @@ class Throttle():
         """Set KP info and start processing task."""
         if kp_id in self.servers:
             raise DuplicateError(f"{kp_id} already exists")
-        self.servers[kp_id] = ThrottledServer(kp_id, **kp_info)
+        self.servers[kp_id] = ThrottledServer(kp_id, **{
+            **self.server_defaults,
+            **kp_info,
+        })
         await self.servers[kp_id].__aenter__()
 
     async def unregister_kp(
@@ -409,3 +1213,12 @@ class Throttle():
     ) -> dict:
         """ Queue up a query for batching and return when completed """
         return await self.servers[kp_id].query(query)
+
+    async def __aenter__(self):
+        """Enter context."""
+        return self
+
+    async def __aexit__(self, *args):
+        """Cancel all KP processing tasks and close their connections."""
+        for kp_id in list(self.servers):
+            await self.unregister_kp(kp_id)
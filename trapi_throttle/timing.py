@@ -0,0 +1,135 @@
+"""Per-request latency breakdowns and their export as spans."""
+import time
+from typing import Optional
+
+try:
+    from opentelemetry import trace
+except ImportError:  # pragma: no cover
+    trace = None
+
+
+class BatchTiming():
+    """
+    When a batch got through each stage, in time.monotonic() seconds.
+
+    Stages that did not happen (e.g. the KP call, if every curie was
+    cached) stay None.
+    """
+
+    __slots__ = (
+        "id",
+        "linger_start",
+        "rate_limit_start",
+        "rate_limit_end",
+        "sent",
+        "received",
+        "split",
+    )
+
+    def __init__(self, id: int):
+        """Initialize."""
+        self.id = id
+        self.linger_start: Optional[float] = None
+        self.rate_limit_start: Optional[float] = None
+        self.rate_limit_end: Optional[float] = None
+        self.sent: Optional[float] = None
+        self.received: Optional[float] = None
+        self.split: Optional[float] = None
+
+    def stage_ends(self) -> list[tuple[str, Optional[float]]]:
+        """Each stage and when it ended."""
+        return [
+            # waiting for an in-flight slot and the previous batch
+            ("queue", self.linger_start),
+            ("linger", self.rate_limit_start),
+            ("rate_limit", self.rate_limit_end),
+            # merging and preprocessing
+            ("merge", self.sent),
+            ("kp", self.received),
+            ("split", self.split),
+        ]
+
+
+def breakdown(
+        queued_at: float,
+        batch: Optional[BatchTiming],
+) -> dict[str, float]:
+    """
+    Split the time a request took, from queued_at until its batch
+    was split, into stages, in seconds.
+
+    Each stage lasts from the end of the previous one, or the
+    request's arrival if that was later, until its own end.
+    """
+    if batch is None:
+        return {}
+    durations = dict()
+    previous = queued_at
+    for stage, end in batch.stage_ends():
+        if end is None:
+            continue
+        durations[stage] = max(end - previous, 0.0)
+        previous = max(previous, end)
+    durations["total"] = previous - queued_at
+    return durations
+
+
+def server_timing(durations: dict[str, float]) -> str:
+    """Format a breakdown as a Server-Timing header value."""
+    return ", ".join(
+        f"{stage};dur={duration * 1000:.1f}"
+        for stage, duration in durations.items()
+    )
+
+
+def to_ns(timestamp: float, offset: int) -> int:
+    """Convert a time.monotonic() timestamp to nanoseconds since the epoch."""
+    return int(timestamp * 1e9) + offset
+
+
+def export_spans(
+        kp_id: str,
+        batch: BatchTiming,
+        arrivals: list[float],
+):
+    """
+    Export a batch as OpenTelemetry spans.
+
+    The batch gets a span with a child per stage, and each of its
+    requests (given by their arrival times) a span that links to it.
+    Requires opentelemetry-api; spans go nowhere unless an SDK is set up.
+    """
+    tracer = trace.get_tracer("trapi_throttle")
+    offset = time.time_ns() - int(time.monotonic() * 1e9)
+    stages = [(stage, end) for stage, end in batch.stage_ends()[1:] if end is not None]
+    start = batch.linger_start
+    batch_span = tracer.start_span(
+        "batch",
+        start_time=to_ns(start, offset),
+        attributes={
+            "trapi_throttle.kp": kp_id,
+            "trapi_throttle.batch": batch.id,
+            "trapi_throttle.subrequests": len(arrivals),
+        },
+    )
+    context = trace.set_span_in_context(batch_span)
+    for stage, end in stages:
+        tracer.start_span(
+            stage,
+            context=context,
+            start_time=to_ns(start, offset),
+        ).end(end_time=to_ns(end, offset))
+        start = end
+    batch_span.end(end_time=to_ns(start, offset))
+
+    link = trace.Link(batch_span.get_span_context())
+    for queued_at in arrivals:
+        tracer.start_span(
+            "request",
+            start_time=to_ns(queued_at, offset),
+            links=[link],
+            attributes={
+                "trapi_throttle.kp": kp_id,
+                "trapi_throttle.batch": batch.id,
+            },
+        ).end(end_time=to_ns(start, offset))
@@ -1,4 +1,7 @@
+from collections import defaultdict
 import copy
+import json
+from typing import Optional
 
 from reasoner_pydantic import Message, QueryGraph
 
@@ -11,6 +14,10 @@ class UnableToMerge(BaseException):
     """ Unable to merge given query graphs """
 
 
+class InvalidMessage(ValueError):
+    """TRAPI message lacks the structure needed to split it."""
+
+
 def get_curies(qgraph: QueryGraph) -> dict[str, list[str]]:
     """
     Pull curies from query graph and
@@ -33,6 +40,181 @@ def remove_curies(qgraph: QueryGraph) -> dict[str, list[str]]:
     return qgraph
 
 
+# Properties whose list values are unordered
+UNORDERED_PROPERTIES = ("categories", "predicates")
+
+
+def normalize_element(element: dict, exclude: tuple[str, ...] = ()) -> str:
+    """
+    Serialize a qnode or qedge with sorted keys and
+    sorted unordered lists, leaving out the excluded properties.
+    """
+    element = {
+        key: (
+            sorted(value)
+            if key in UNORDERED_PROPERTIES and isinstance(value, list)
+            else value
+        )
+        for key, value in element.items()
+        if key not in exclude
+    }
+    return json.dumps(element, sort_keys=True)
+
+
+def fingerprint(qgraph: QueryGraph) -> tuple[str, dict[str, str], dict[str, str]]:
+    """
+    Compute a canonical fingerprint of a query graph without its curies.
+
+    Returns the fingerprint and mappings from the query graph's
+    node and edge ids to canonical ids (n0, n1, ... and e0, e1, ...).
+    Query graphs with equal fingerprints are identical, apart from curies,
+    once renamed using these mappings.
+    """
+    nodes = qgraph["nodes"]
+    edges = qgraph["edges"]
+
+    # Label nodes by their properties and whether they are pinned
+    node_labels = {
+        node_id: normalize_element({
+            **node,
+            "ids": node.get("ids") is not None,
+        })
+        for node_id, node in nodes.items()
+    }
+    edge_labels = {
+        edge_id: normalize_element(edge, exclude=("subject", "object"))
+        for edge_id, edge in edges.items()
+    }
+
+    # Refine node colors with their neighborhoods until stable
+    # so that node order depends on structure rather than ids
+    colors = rank(node_labels)
+    while True:
+        signatures = {
+            node_id: (color, [], [])
+            for node_id, color in colors.items()
+        }
+        for edge_id, edge in edges.items():
+            subject_color = colors.get(edge["subject"], -1)
+            object_color = colors.get(edge["object"], -1)
+            if edge["subject"] in signatures:
+                signatures[edge["subject"]][1].append(
+                    (edge_labels[edge_id], object_color)
+                )
+            if edge["object"] in signatures:
+                signatures[edge["object"]][2].append(
+                    (edge_labels[edge_id], subject_color)
+                )
+        refined = rank({
+            node_id: (color, sorted(outgoing), sorted(incoming))
+            for node_id, (color, outgoing, incoming) in signatures.items()
+        })
+        if len(set(refined.values())) == len(set(colors.values())):
+            break
+        colors = refined
+
+    # Nodes that cannot be told apart are ordered by id. That may
+    # miss some equivalent query graphs but never merges different ones.
+    node_map = {
+        node_id: f"n{index}"
+        for index, node_id in enumerate(
+            sorted(nodes, key=lambda node_id: (colors[node_id], node_id))
+        )
+    }
+    canonical_edges = {
+        edge_id: (
+            node_map.get(edge["subject"], edge["subject"]),
+            node_map.get(edge["object"], edge["object"]),
+            edge_labels[edge_id],
+        )
+        for edge_id, edge in edges.items()
+    }
+    edge_map = {
+        edge_id: f"e{index}"
+        for index, edge_id in enumerate(
+            sorted(edges, key=lambda edge_id: (canonical_edges[edge_id], edge_id))
+        )
+    }
+
+    return json.dumps({
+        "nodes": {
+            node_map[node_id]: label
+            for node_id, label in node_labels.items()
+        },
+        "edges": {
+            edge_map[edge_id]: canonical_edge
+            for edge_id, canonical_edge in canonical_edges.items()
+        },
+    }, sort_keys=True), node_map, edge_map
+
+
+def rank(labels: dict) -> dict[str, int]:
+    """ Replace each label with its rank among the distinct labels """
+    ranks = {
+        label: index
+        for index, label in enumerate(sorted(set(
+            json.dumps(label) for label in labels.values()
+        )))
+    }
+    return {
+        key: ranks[json.dumps(label)]
+        for key, label in labels.items()
+    }
+
+
+def rename_bindings(
+        results: list[dict],
+        node_map: dict[str, str],
+        edge_map: dict[str, str],
+) -> list[dict]:
+    """
+    Return copies of the results with the binding keys renamed.
+
+    Bindings themselves are shared with the given results.
+    """
+    return [
+        {
+            **result,
+            "node_bindings": {
+                node_map.get(qnode_id, qnode_id): bindings
+                for qnode_id, bindings in result["node_bindings"].items()
+            },
+            "edge_bindings": {
+                edge_map.get(qedge_id, qedge_id): bindings
+                for qedge_id, bindings in result["edge_bindings"].items()
+            },
+        }
+        for result in results
+    ]
+
+
+def merge_parts(parts) -> tuple[dict, list[dict]]:
+    """
+    Combine (kgraph, results) pairs into one.
+
+    Nodes, edges and results are shared with the parts. Results
+    that appear in several parts are kept once; copies of a result
+    made by rename_bindings count as the same result, since they
+    share its bindings.
+    """
+    kgraph = {"nodes": dict(), "edges": dict()}
+    results = []
+    seen = set()
+    for part_kgraph, part_results in parts:
+        kgraph["nodes"].update(part_kgraph["nodes"])
+        kgraph["edges"].update(part_kgraph["edges"])
+        for result in part_results:
+            key = tuple(
+                id(bindings)
+                for bindings_by_id in (result["node_bindings"], result["edge_bindings"])
+                for bindings in bindings_by_id.values()
+            ) or id(result)
+            if key not in seen:
+                seen.add(key)
+                results.append(result)
+    return kgraph, results
+
+
 def remove_unbound_from_kg(message):
     """
     Remove all knowledge graph nodes and edges without a binding
@@ -73,36 +255,168 @@ def result_contains_node_bindings(
     return True
 
 
+def index_results(results: list[dict]) -> dict[tuple[str, str], list[int]]:
+    """
+    Map each (qnode id, kg id) node binding to the
+    positions of the results that contain it
+    """
+    index = defaultdict(list)
+    for position, result in enumerate(results):
+        add_to_index(index, position, result)
+    return index
+
+
+def add_to_index(
+        index: dict[tuple[str, str], list[int]],
+        position: int,
+        result: dict,
+):
+    """Add the node bindings of the result at the given position to an index"""
+    for qg_id, bindings in result["node_bindings"].items():
+        for binding in bindings:
+            positions = index[(qg_id, binding["id"])]
+            if not positions or positions[-1] != position:
+                positions.append(position)
+
+
 def filter_by_curie_mapping(
         message: Message,
         curie_mapping: dict[str, list[str]],
         kp_id: str = "KP",
+        index: Optional[dict[tuple[str, str], list[int]]] = None,
 ) -> Message:
     """
     Filter a message to ensure that all results
     contain the bindings specified in the curie_mapping
+
+    If an index of the message results (see index_results) is
+    provided, it is used instead of scanning every result.
     """
-    # Only keep results where there is a node binding
-    # that connects to our given kgraph_node_id
-    results = [
-        result for result in (message.get("results") or [])
-        if result_contains_node_bindings(result, curie_mapping)
-    ]
+    results = message.get("results") or []
+    if index is None:
+        # Only keep results where there is a node binding
+        # that connects to our given kgraph_node_id
+        results = [
+            result for result in results
+            if result_contains_node_bindings(result, curie_mapping)
+        ]
+    else:
+        positions = None
+        for qg_id, kg_ids in curie_mapping.items():
+            matching = set()
+            for kg_id in kg_ids:
+                matching.update(index.get((qg_id, kg_id), ()))
+            positions = matching if positions is None else positions & matching
+        if positions is not None:
+            results = [results[position] for position in sorted(positions)]
 
     # Construct result-specific knowledge graph
-    kgraph = {
-        "nodes": {
-            binding["id"]: message["knowledge_graph"]["nodes"][binding["id"]]
-            for result in results
-            for _, bindings in result["node_bindings"].items()
-            for binding in bindings
-        },
-        "edges": {
-            binding["id"]: message["knowledge_graph"]["edges"][binding["id"]]
-            for result in results
-            for _, bindings in result["edge_bindings"].items()
-            for binding in bindings
-        },
-    }
+    try:
+        kgraph = {
+            "nodes": {
+                binding["id"]: message["knowledge_graph"]["nodes"][binding["id"]]
+                for result in results
+                for _, bindings in result["node_bindings"].items()
+                for binding in bindings
+            },
+            "edges": {
+                binding["id"]: message["knowledge_graph"]["edges"][binding["id"]]
+                for result in results
+                for _, bindings in result["edge_bindings"].items()
+                for binding in bindings
+            },
+        }
+    except KeyError as err:
+        raise BatchingError(
+            f"{kp_id} returned a binding to {err} that is not in its knowledge graph"
+        ) from err
 
     return kgraph, results
+
+
+def check_query(query) -> dict:
+    """
+    Check that a TRAPI query has the structure the throttle relies on:
+    a message with a query graph of qnodes, with lists of curies if
+    pinned, and of qedges with a subject and an object.
+
+    This is much cheaper than full validation. Nothing else is checked.
+    """
+    if not isinstance(query, dict) or not isinstance(query.get("message"), dict):
+        raise InvalidMessage("query has no message")
+    qgraph = query["message"].get("query_graph")
+    if not (
+        isinstance(qgraph, dict)
+        and isinstance(qgraph.get("nodes"), dict)
+        and isinstance(qgraph.get("edges"), dict)
+    ):
+        raise InvalidMessage("query_graph must have nodes and edges")
+    for node_id, node in qgraph["nodes"].items():
+        if not isinstance(node, dict):
+            raise InvalidMessage(f"qnode {node_id} is not an object")
+        curies = node.get("ids")
+        if curies is not None and not (
+            isinstance(curies, list)
+            and all(isinstance(curie, str) for curie in curies)
+        ):
+            raise InvalidMessage(f"ids of qnode {node_id} is not a list of curies")
+    for edge_id, edge in qgraph["edges"].items():
+        if not (
+            isinstance(edge, dict)
+            and isinstance(edge.get("subject"), str)
+            and isinstance(edge.get("object"), str)
+        ):
+            raise InvalidMessage(f"qedge {edge_id} needs a subject and an object")
+    return query
+
+
+def check_bindings(bindings, name: str):
+    """Check a result's node or edge bindings."""
+    if not isinstance(bindings, dict):
+        raise InvalidMessage(f"{name} is not an object")
+    for qg_id, binding_list in bindings.items():
+        if not isinstance(binding_list, list) or not all(
+            isinstance(binding, dict) and isinstance(binding.get("id"), str)
+            for binding in binding_list
+        ):
+            raise InvalidMessage(f"{name}[{qg_id}] is not a list of bindings")
+
+
+def check_response(response) -> dict:
+    """
+    Check that a TRAPI response has the structure that splitting relies on:
+    a message whose knowledge_graph and results are missing, null or
+    well-formed, with a knowledge_graph if there are results.
+
+    This is much cheaper than full validation. Nothing else is checked.
+    """
+    if not isinstance(response, dict) or not isinstance(response.get("message"), dict):
+        raise InvalidMessage("response has no message")
+    message = response["message"]
+
+    kgraph = message.get("knowledge_graph")
+    if kgraph is not None and not (
+        isinstance(kgraph, dict)
+        and isinstance(kgraph.get("nodes"), dict)
+        and isinstance(kgraph.get("edges"), dict)
+    ):
+        raise InvalidMessage("knowledge_graph must have nodes and edges")
+
+    results = message.get("results")
+    if results is None:
+        return response
+    if not isinstance(results, list):
+        raise InvalidMessage("results is not a list")
+    if results and kgraph is None:
+        raise InvalidMessage("results without a knowledge_graph")
+    for result in results:
+        check_result(result)
+    return response
+
+
+def check_result(result):
+    """Check that a result has node and edge bindings."""
+    if not isinstance(result, dict):
+        raise InvalidMessage("result is not an object")
+    check_bindings(result.get("node_bindings"), "node_bindings")
+    check_bindings(result.get("edge_bindings"), "edge_bindings")
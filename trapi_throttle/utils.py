@@ -1,4 +1,8 @@
 import asyncio
+import datetime
+from email.utils import parsedate_to_datetime
+import math
+from typing import Optional
 
 
 def all_equal(values: list):
@@ -14,6 +18,49 @@ def get_keys_with_value(dct: dict, value):
     ]
 
 
+def invert(dct: dict) -> dict:
+    """ Swap the keys and values of a one-to-one mapping """
+    return {v: k for k, v in dct.items()}
+
+
+def ewma(average: Optional[float], value: float, alpha: float = 0.2) -> float:
+    """ Update an exponentially weighted moving average """
+    if average is None:
+        return value
+    return (1 - alpha) * average + alpha * value
+
+
+def parse_retry_after(
+        value: Optional[str],
+        max_delay: Optional[float] = None,
+) -> Optional[float]:
+    """
+    Parse a Retry-After header, either delay-seconds or an HTTP-date,
+    into a number of seconds to wait, at most max_delay if given.
+    Return None if it is missing or invalid.
+    """
+    if value is None:
+        return None
+    value = value.strip()
+    try:
+        delay = float(value)
+    except ValueError:
+        try:
+            date = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        if date.tzinfo is None:
+            date = date.replace(tzinfo=datetime.timezone.utc)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        delay = (date - now).total_seconds()
+    if not math.isfinite(delay):
+        return None
+    delay = max(delay, 0.0)
+    if max_delay is not None:
+        delay = min(delay, max_delay)
+    return delay
+
+
 async def gather_dict(dct):
     """ Gather a dict of coroutines """
     values = await asyncio.gather(*dct.values())